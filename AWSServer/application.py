@@ -1,4 +1,5 @@
 import json
+import os
 import time
 import atexit
 import io
@@ -19,9 +20,19 @@ from flask_limiter.util import get_remote_address
 
 import zipfile
 
-from sign import load_saved_keys, sign
+from sign import Signer
 
+from block import Record
 from blockgrid import Blockgrid
+from capacity import CapacityManager
+from jobs import MiningJobs, QueueFull
+from spatial import block_of, parse_position, region_blocks
+from storage import SQLiteStorage
+from streaming import stream_grid
+from wire import read_request, respond
+
+# The most blocks one batched read can ask for
+MAX_BATCH_BLOCKS = 125
 
 
 def create_asset_table(dynamodb=None):
@@ -97,12 +108,15 @@ except dynamodb_client.exceptions.ResourceInUseException:
     pass
 
 table = dynamodb.Table('Assets')
+capacity = CapacityManager.from_table(table)
 
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Decimal):
             return int(obj)
+        if isinstance(obj, Record):
+            return obj.to_dict()
         return super(DecimalEncoder, self).default(obj)
 
 
@@ -119,7 +133,22 @@ def get_app():
     node_identifier = str(uuid4()).replace('-', '')
     moderators = set(line.strip() for line in open('moderators'))
     sem = threading.Semaphore()
-    blockgrid = Blockgrid()
+    # Nodes can keep the grid on local disk instead of in DynamoDB, and can queue block saves to merge bursts
+    storage = SQLiteStorage(os.environ["GRID_DATABASE"]) if "GRID_DATABASE" in os.environ else None
+    write_behind = float(os.environ["GRID_WRITE_BEHIND"]) if "GRID_WRITE_BEHIND" in os.environ else None
+    # Starting from a local snapshot only reads the blocks that changed since it was written
+    snapshot = os.environ.get("GRID_SNAPSHOT")
+    # Or read blocks only when they are first used, keeping the most recently used ones in memory
+    cache_size = int(os.environ["GRID_CACHE_SIZE"]) if "GRID_CACHE_SIZE" in os.environ else None
+    # Signatures verified before a restart are not verified again
+    signature_cache = os.environ.get("GRID_SIGNATURE_CACHE")
+    blockgrid = Blockgrid(storage, write_behind=write_behind, snapshot=snapshot, cache_size=cache_size,
+                          signature_cache=signature_cache)
+    atexit.register(blockgrid.flush)
+    mining_jobs = MiningJobs(blockgrid)
+    # The node's keys are parsed once, and again whenever the key files are replaced
+    signer = Signer()
+    print("Loaded {} blocks in {:.2f}s".format(blockgrid.load_stats["blocks"], blockgrid.load_stats["seconds"]))
 
     with open('webAPIkey', 'r') as file:
         apiKey = file.read().replace('\n', '')
@@ -151,14 +180,17 @@ def get_app():
 
     scheduler = BackgroundScheduler()
     scheduler.add_job(func=remove_unused_bundles, trigger="interval", days=3)
+    if snapshot is not None:
+        scheduler.add_job(func=lambda: blockgrid.save(snapshot), trigger="interval", minutes=30)
+        atexit.register(lambda: blockgrid.save(snapshot))
+    if signature_cache is not None:
+        scheduler.add_job(func=blockgrid.verifier.cache.save, trigger="interval", minutes=30)
+        atexit.register(blockgrid.verifier.cache.save)
     scheduler.start()
 
     # Shut down the scheduler when exiting the app
     atexit.register(lambda: scheduler.shutdown())
 
-    # if os.path.isfile("./blockgrid.pkl"):
-    #    blockgrid.load("blockgrid.pkl")
-
     def is_moderator(ticket):
         moderator = False
         try:
@@ -174,7 +206,6 @@ def get_app():
     @app.route('/mine', methods=['GET'])
     @limiter.limit("1 per hour")
     def mine():
-        # We run the proof of work algorithm to get the next proof...
         values = request.get_json()
 
         index = tuple(values["index"])
@@ -185,30 +216,35 @@ def get_app():
         if blockgrid.grid[index]["owner"] is not None:
             return 'Block has already been mined', 400
 
-        block = blockgrid.grid[index].copy()
-        block["owner"] = values["signature"]
-        last_proof = blockgrid.hash_without_proof(block)
-        proof = blockgrid.proof_of_work(last_proof, index)
+        # The proof of work is run in the background, the result is fetched from /mine/<job_id>
+        try:
+            job = mining_jobs.submit(index, values["signature"])
+        except QueueFull:
+            return 'Too many blocks are being mined, try again later', 503
 
-        # Forge the new Block by adding it to the chain
-        blockgrid.sign_block(index, proof, values["signature"])
+        return jsonify(mining_jobs.describe(job)), 202
 
-        response = {
-            'message': "New Block Forged",
-            'index': blockgrid.grid[index]['index'],
-            'owner': blockgrid.grid[index]['owner'],
-            'data': blockgrid.grid[index]['data'],
-            'proof': blockgrid.grid[index]['proof'],
-            'previous_hash': blockgrid.grid[index]['previous_hash'],
-        }
+    @app.route('/mine/<job_id>', methods=['GET'])
+    @limiter.limit("120 per hour")
+    def mining_status(job_id):
+        job = mining_jobs.get(job_id)
+        if job is None:
+            return 'Unknown mining job', 404
 
-        return jsonify(response), 200
+        return jsonify(mining_jobs.describe(job)), 200
 
     @app.route('/', methods=['GET'])
     @limiter.limit("1 per day")
     def check():
         return jsonify({}), 200
 
+    @app.route('/stats', methods=['GET'])
+    @limiter.limit("10 per hour")
+    def stats():
+        response = blockgrid.stats()
+        response['assets'] = capacity.stats()
+        return jsonify(response), 200
+
     @app.route('/transactions/new', methods=['POST'])
     @limiter.limit("3 per hour")
     def new_transaction():
@@ -229,24 +265,11 @@ def get_app():
         return jsonify(response), 200
 
     def persistent_put(item):
-        result = None
-        while result is None:
-            try:
-                table.put_item(Item=item)
-            except dynamodb_client.exceptions.ProvisionedThroughputExceededException:
-                time.sleep(1.0)
-                continue
-            result = True
+        capacity.call("write", lambda: table.put_item(Item=item, ReturnConsumedCapacity='TOTAL'),
+                      capacity.write_units(item))
 
     def persistent_query(kce):
-        result = None
-        while result is None:
-            try:
-                result = table.query(KeyConditionExpression=kce)
-            except dynamodb_client.exceptions.ProvisionedThroughputExceededException:
-                time.sleep(1.0)
-                pass
-        return result
+        return capacity.call("read", lambda: table.query(KeyConditionExpression=kce, ReturnConsumedCapacity='TOTAL'))
 
     @app.route('/transactions/new/unsigned', methods=['POST'])
     @limiter.limit("3 per hour")
@@ -271,7 +294,6 @@ def get_app():
             for chunk in chunks:
                 persistent_put({"name": k + "_" + str(ix), "time": millis, "bundle": chunk})
                 ix += 1
-                time.sleep(3.0)
 
         for k, v in values.items():
             if moderator and k == "delete":
@@ -302,11 +324,12 @@ def get_app():
                 loc = tuple(int(x / 500) for x in v["position"])
                 indexes[loc][k] = v
 
+        finals = [{"index": k, "approved": moderator, "data": json.dumps(v), "time": millis} for k, v in indexes.items()]
+        signatures = signer.sign_many([final["data"].encode('utf-8') for final in finals])
+
         blocks = []
-        for k, v in indexes.items():
-            final = {"index": k, "approved": moderator, "data": json.dumps(v), "time": millis}
-            private_key, _ = load_saved_keys()
-            final["signature"] = sign(private_key, final["data"].encode('utf-8')).decode('latin-1')
+        for final, signature in zip(finals, signatures):
+            final["signature"] = signature.decode('latin-1')
 
             # Create a new Transaction
             index = blockgrid.new_transaction(tuple(final['index']), final['data'], final['signature'], final["time"],
@@ -317,9 +340,71 @@ def get_app():
 
         return jsonify(response), 200
 
+    def not_modified(tag, values=None):
+        """
+        Answer with 304 Not Modified if the client already has the response tagged tag, which it tells us with
+        If-None-Match or, for POST routes, with an etag field in the body
+        :param tag: <str> The ETag of the response
+        :param values: <dict> The body of the request
+        :return: <Response> The 304 response, or None if the response has to be sent
+        """
+        if not request.if_none_match.contains_weak(tag) and (values is None or values.get('etag') != tag):
+            return None
+        response = app.response_class(status=304)
+        response.set_etag(tag, weak=True)
+        return response
+
+    def block_data(index, moderator):
+        """
+        :param index: <tuple> The index of a block
+        :param moderator: <bool> Whether the client is a moderator, who also sees unapproved data
+        :return: <list> The data of the block the client can see
+        """
+        return [{"data": x["data"], "approved": x["approved"]} for x in blockgrid.grid[index]["data"]
+                if x["approved"] or moderator]
+
+    def zip_bundles(indexes, moderator, since):
+        """
+        Zip the asset bundles used by the data of some blocks. A bundle used in several blocks is only fetched and
+        added once
+        :param indexes: <list> The indexes of the blocks
+        :param moderator: <bool> Whether the client is a moderator, whose archive includes unapproved data
+        :param since: <int> Only bundles stored after this time, in milliseconds, are added
+        :return: <BytesIO> The archive
+        """
+        zb = io.BytesIO()
+        # Bundles already looked for, whether or not they were found
+        seen = set()
+        with zipfile.ZipFile(zb, "a", zipfile.ZIP_DEFLATED, False) as zippedBundles:
+            for index in indexes:
+                for item in blockgrid.grid[index]["data"]:
+                    if not (item["approved"] or moderator):
+                        continue
+                    for k2, v2, in json.loads(item["data"]).items():
+                        name = v2["filepath"]
+                        if name in seen:
+                            continue
+                        seen.add(name)
+                        ix = 0
+                        bundle = b""
+                        while True:
+                            out = persistent_query(Key('time').gt(since) &
+                                                   Key("name").eq(name + "_" + str(ix)))['Items']
+                            if len(out) == 0:
+                                break
+                            bundle += out[0]["bundle"].value
+                            ix += 1
+
+                        if len(bundle) > 0:
+                            zippedBundles.writestr(name, io.BytesIO(bundle).getvalue(),
+                                                   compress_type=zipfile.ZIP_DEFLATED)
+
+        zb.seek(0)
+        return zb
+
     # This has to be a POST type because of unity HTTP stupidity, really should be GET
     @app.route('/grid/index', methods=['POST'])
-    @limiter.limit("3 per hour")
+    @limiter.limit("3 per hour", deduct_when=lambda response: response.status_code != 304)
     def data_at_index():
         values = request.get_json()
 
@@ -330,15 +415,23 @@ def get_app():
         moderator = is_moderator(values["ticket"])
         index = tuple(int(x / 500) for x in values['index'])
 
+        # Polling clients that already have this version of the block get an empty 304
+        tag = f"{blockgrid.etag(index)}-{int(moderator)}"
+        cached = not_modified(tag, values)
+        if cached is not None:
+            return cached
+
         response = {
-            'block': [{"data": x["data"], "approved": x["approved"]} for x in blockgrid.grid[index]["data"]
-                      if x["approved"] or moderator],
+            'block': block_data(index, moderator),
+            'etag': tag,
         }
-        return jsonify(response), 200
+        response = jsonify(response)
+        response.set_etag(tag, weak=True)
+        return response, 200
 
     # This has to be a POST type because of unity HTTP stupidity, really should be GET
     @app.route('/grid/index/bundles', methods=['POST'])
-    @limiter.limit("3 per hour")
+    @limiter.limit("3 per hour", deduct_when=lambda response: response.status_code != 304)
     def bundles_at_index():
         values = request.get_json()
 
@@ -349,83 +442,192 @@ def get_app():
         moderator = is_moderator(values["ticket"])
 
         index = tuple(int(x / 500) for x in values['index'])
-        zb = io.BytesIO()
-        bundles = set()
-        with zipfile.ZipFile(zb, "a", zipfile.ZIP_DEFLATED, False) as zippedBundles:
-            for item in blockgrid.grid[index]["data"]:
-                for k, v in item.items():
-                    if k == "data" and (item["approved"] or moderator):
-                        for k2, v2, in json.loads(v).items():
-                            name = v2["filepath"]
-                            ix = 0
-                            bundle = b""
-                            while True and name not in bundles:
-                                out = persistent_query(Key('time').gt(values['time']) &
-                                                       Key("name").eq(name + "_" + str(ix)))['Items']
-                                if len(out) == 0:
-                                    break
-                                bundle += out[0]["bundle"].value
-                                ix += 1
-
-                            if len(bundle) > 0:
-                                bundles.add(name)
-                                zippedBundles.writestr(name, io.BytesIO(bundle).getvalue(),
-                                                       compress_type=zipfile.ZIP_DEFLATED)
+        tag = f"{blockgrid.etag(index)}-{int(moderator)}-{values['time']}"
+        cached = not_modified(tag, values)
+        if cached is not None:
+            return cached
 
-        zb.seek(0)
-        return send_file(
-            zb,
+        response = send_file(
+            zip_bundles([index], moderator, values['time']),
             attachment_filename="grid/index",
             mimetype='application/octet-stream',
             as_attachment=True
         )
+        response.set_etag(tag, weak=True)
+        return response
+
+    def batch_indexes(values):
+        """
+        The blocks a batched read asks for, either as a list of world positions in 'indexes' or as a box in world
+        space with 'min' and 'max' corners
+        :param values: <dict> The body of the request
+        :return: <list> The indexes of the blocks that exist, without repeats, in the order they were asked for
+        :raises ValueError: If no blocks are given or there are more than MAX_BATCH_BLOCKS of them
+        """
+        try:
+            if 'indexes' in values:
+                indexes = [block_of(parse_position(position)) for position in values['indexes']]
+            elif 'min' in values and 'max' in values:
+                indexes = region_blocks(parse_position(values['min']), parse_position(values['max']),
+                                        MAX_BATCH_BLOCKS)
+            else:
+                raise ValueError("Missing values")
+        except (TypeError, OverflowError):
+            raise ValueError("Invalid indexes")
+        indexes = list(dict.fromkeys(indexes))
+        if len(indexes) > MAX_BATCH_BLOCKS:
+            raise ValueError(f"A batch can hold at most {MAX_BATCH_BLOCKS} blocks")
+        return [index for index in indexes if index in blockgrid.grid]
 
-    @app.route('/grid', methods=['GET'])
+    # This has to be a POST type because of unity HTTP stupidity, really should be GET
+    @app.route('/grid/indexes', methods=['POST'])
+    @limiter.limit("3 per hour")
+    def data_at_indexes():
+        values = request.get_json()
+
+        if 'ticket' not in values:
+            return 'Missing values', 400
+        try:
+            indexes = batch_indexes(values)
+        except ValueError as e:
+            return str(e), 400
+
+        # One moderator check covers the whole batch
+        moderator = is_moderator(values["ticket"])
+        response = {
+            'blocks': [{'index': list(index), 'block': block_data(index, moderator),
+                        'etag': f"{blockgrid.etag(index)}-{int(moderator)}"} for index in indexes],
+        }
+        return jsonify(response), 200
+
+    # This has to be a POST type because of unity HTTP stupidity, really should be GET
+    @app.route('/grid/indexes/bundles', methods=['POST'])
     @limiter.limit("3 per hour")
+    def bundles_at_indexes():
+        values = request.get_json()
+
+        if 'ticket' not in values or 'time' not in values:
+            return 'Missing values', 400
+        try:
+            indexes = batch_indexes(values)
+        except ValueError as e:
+            return str(e), 400
+
+        moderator = is_moderator(values["ticket"])
+        return send_file(
+            zip_bundles(indexes, moderator, values['time']),
+            attachment_filename="grid/indexes",
+            mimetype='application/octet-stream',
+            as_attachment=True
+        )
+
+    # This has to be a POST type because of unity HTTP stupidity, really should be GET
+    @app.route('/grid/objects', methods=['POST'])
+    @limiter.limit("30 per hour")
+    def objects_in_region():
+        values = request.get_json()
+
+        # The region is either a sphere, with a center and radius, or a box, with its min and max corners
+        if 'ticket' not in values or not (('center' in values and 'radius' in values) or
+                                          ('min' in values and 'max' in values)):
+            return 'Missing values', 400
+
+        try:
+            if 'center' in values:
+                found = blockgrid.spatial.sphere(parse_position(values['center']), float(values['radius']))
+            else:
+                found = blockgrid.spatial.box(parse_position(values['min']), parse_position(values['max']))
+        except (TypeError, ValueError):
+            return 'Invalid region', 400
+
+        moderator = is_moderator(values["ticket"])
+        response = {
+            'objects': [{'index': list(idx), 'name': name, 'object': obj, 'approved': approved}
+                        for idx, _, name, obj, approved in found if approved or moderator],
+        }
+        return jsonify(response), 200
+
+    @app.route('/grid', methods=['GET'])
+    @limiter.limit("3 per hour", deduct_when=lambda response: response.status_code != 304)
     def full_grid():
+        tag = blockgrid.etag()
+        cached = not_modified(tag)
+        if cached is not None:
+            return cached
+
         response = {
-            'grid': {":".join(map(str, k)): v for k, v in blockgrid.grid.items()},
+            'grid': blockgrid.grid,
             'length': len(blockgrid.grid),
         }
+        response = respond(app, request, response, 'grid')
+        response.set_etag(tag, weak=True)
+        return response, 200
+
+    # Peers compare grids by walking down from the root of the Merkle tree, only into nodes whose digests differ
+    @app.route('/grid/merkle', methods=['GET'])
+    @limiter.limit("60 per hour")
+    def merkle_root():
+        return jsonify(blockgrid.merkle.root()), 200
+
+    @app.route('/grid/merkle/<int:level>/<int(signed=True):i>/<int(signed=True):j>/<int(signed=True):k>',
+               methods=['GET'])
+    @limiter.limit("3000 per hour")
+    def merkle_node(level, i, j, k):
+        response = blockgrid.merkle.node((level, i, j, k))
+        if response is None:
+            return 'No blocks under this node', 404
+
+        # The leaves are blocks, which are sent along so the peer does not have to fetch them separately
+        if level == 0:
+            response['block'] = blockgrid.grid[(i, j, k)]
         return jsonify(response), 200
 
+    # Peers that have synced before only need the blocks changed since then
+    @app.route('/grid/changes', methods=['GET'])
+    @limiter.limit("120 per hour")
+    def grid_changes():
+        values = read_request(request)
+
+        versions = None
+        if 'versions' in values:
+            versions = {tuple(map(int, k.split(":"))): tuple(v) if isinstance(v, list) else (v, None)
+                        for k, v in values['versions'].items()}
+
+        response = blockgrid.changes_since(values.get('since'), values.get('epoch'), versions)
+        response['length'] = len(blockgrid.grid)
+        return respond(app, request, response, 'grid'), 200
+
     @app.route('/grid/compare', methods=['GET'])
     @limiter.limit("10 per hour")
     def compare_grids():
-        values = request.get_json()
-
-        other_grid = {tuple(map(int, k.split(":"))): v for k, v in values.get('grid').items()}
+        values = read_request(request, ['grid'])
 
         response = {
-            'auth': blockgrid.compare_grids(other_grid),
+            'auth': blockgrid.compare_grids(values['grid'], bool(values.get('full'))),
         }
-        return jsonify(response), 200
+        return respond(app, request, response), 200
 
     @app.route('/grid/replace', methods=['PUT'])
     @limiter.limit("10 per hour")
     def replace_grid():
-        values = request.get_json()
+        values = read_request(request, ['grid'])
 
-        other_grid = {tuple(map(int, k.split(":"))): v for k, v in values.get('grid').items()}
-        blockgrid.replace_grid(other_grid)
+        blockgrid.replace_grid(values['grid'])
 
         response = {
             'message': "grid has been replaced",
         }
-        return jsonify(response), 200
+        return respond(app, request, response), 200
 
     @app.route('/grid/update', methods=['GET'])
     @limiter.limit("10 per hour")
     def update_grids():
-        values = request.get_json()
-
-        grid1 = {tuple(map(int, k.split(":"))): v for k, v in values.get('shorter_grid').items()}
-        grid2 = {tuple(map(int, k.split(":"))): v for k, v in values.get('longer_grid').items()}
+        values = read_request(request, ['shorter_grid', 'longer_grid'])
 
         response = {
-            'grid': {":".join(map(str, k)): v for k, v in blockgrid.update_grid(grid1, grid2).items()},
+            'grid': blockgrid.update_grid(values['shorter_grid'], values['longer_grid']),
         }
-        return jsonify(response), 200
+        return respond(app, request, response, 'grid'), 200
 
     @app.route('/nodes/register', methods=['POST'])
     @limiter.limit("10 per hour")
@@ -455,13 +657,13 @@ def get_app():
                 'message': 'Our chain was replaced',
                 'new_chain': blockgrid.grid
             }
-        else:
-            response = {
-                'message': 'Our chain is authoritative',
-                'chain': blockgrid.grid
-            }
+            return stream_grid(app, response, 'new_chain'), 200
 
-        return jsonify(response), 200
+        response = {
+            'message': 'Our chain is authoritative',
+            'chain': blockgrid.grid
+        }
+        return stream_grid(app, response, 'chain'), 200
 
     return app
 
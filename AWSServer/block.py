@@ -0,0 +1,205 @@
+import sys
+
+from collections.abc import MutableMapping
+
+# The value of a field a record does not have, eg. a block read from another node without a version
+MISSING = object()
+
+
+class Record(MutableMapping):
+    """
+    A fixed set of fields held in slots rather than in a dict, which still reads and writes like the dict it
+    replaces. Keys outside FIELDS are kept in a dict of their own, created only when one is set
+    """
+    __slots__ = ("extra",)
+    FIELDS = ()
+
+    def __init__(self, values=(), **kwargs):
+        if kwargs or not isinstance(values, dict):
+            values = dict(values, **kwargs)
+        for field in self.FIELDS:
+            setattr(self, field, self.convert(field, values[field]) if field in values else MISSING)
+        self.extra = {k: v for k, v in values.items() if k not in self.FIELDS} or None
+
+    def convert(self, key, value):
+        """
+        :return: The value to store for key, eg. in a more compact form
+        """
+        return value
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not MISSING:
+                return value
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, self.convert(key, value))
+            return
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            if getattr(self, key) is MISSING:
+                raise KeyError(key)
+            setattr(self, key, MISSING)
+            return
+        if self.extra is None or key not in self.extra:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if getattr(self, field) is not MISSING:
+                yield field
+        if self.extra is not None:
+            yield from list(self.extra)
+
+    def __len__(self):
+        return sum(getattr(self, field) is not MISSING for field in self.FIELDS) + len(self.extra or ())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def __reduce__(self):
+        return type(self), (self.to_dict(),)
+
+    def copy(self):
+        """
+        :return: A shallow copy, like dict.copy()
+        """
+        other = type(self).__new__(type(self))
+        for field in self.FIELDS:
+            setattr(other, field, getattr(self, field))
+        other.extra = dict(self.extra) if self.extra is not None else None
+        return other
+
+    def to_dict(self):
+        """
+        :return: <dict> The record in the dict shape it is sent and stored in
+        """
+        return {k: self[k] for k in self}
+
+
+class Transaction(Record):
+    FIELDS = ("data", "signature", "updated", "approved")
+    __slots__ = FIELDS
+
+
+class Block(Record):
+    FIELDS = ("index", "timestamp", "updated", "data", "proof", "owner", "previous_hash", "previous_index",
+              "version")
+    __slots__ = FIELDS
+
+    def convert(self, key, value):
+        # Indexes arrive as lists from JSON and MessagePack
+        if key == "index" or key == "previous_index":
+            return tuple(value) if isinstance(value, (list, tuple)) else value
+        # The same few owners sign most of the grid, so their keys are only held once
+        if key == "owner":
+            return sys.intern(value) if type(value) is str else value
+        if key == "data" and isinstance(value, list):
+            return [as_transaction(d) for d in value]
+        return value
+
+    def to_dict(self):
+        block = super(Block, self).to_dict()
+        if isinstance(block.get("data"), list):
+            block["data"] = [d.to_dict() if isinstance(d, Record) else d for d in block["data"]]
+        return block
+
+
+def as_transaction(transaction):
+    """
+    :param transaction: <dict|Transaction> A transaction
+    :return: <Transaction> The transaction, converted if it is still a dict
+    """
+    return transaction if isinstance(transaction, Transaction) or not isinstance(transaction, dict) \
+        else Transaction(transaction)
+
+
+def as_block(block):
+    """
+    :param block: <dict|Block> A block
+    :return: <Block> The block, converted if it is still a dict
+    """
+    return block if isinstance(block, Block) else Block(block)
+
+
+def as_blocks(grid):
+    """
+    :param grid: <dict> A grid, eg. one received from a peer
+    :return: <dict> The grid with every block converted to a Block
+    """
+    return {tuple(idx): as_block(block) for idx, block in grid.items()}
+
+
+def plain(obj):
+    """
+    :param obj: Anything
+    :return: obj in the dict shape if it is a Block or Transaction, otherwise obj itself
+    """
+    return obj.to_dict() if isinstance(obj, Record) else obj
+
+
+if __name__ == "__main__":
+    # Compare the memory a large grid takes with its blocks held as dicts, the way they are decoded from storage,
+    # and as Blocks
+    import gc
+    import json
+    import random
+    import tracemalloc
+
+    from time import time
+
+    n = 100000
+    owners = ["-----BEGIN PUBLIC KEY-----" + "%0392x" % random.getrandbits(392 * 4) + "-----END PUBLIC KEY-----"
+              for _ in range(50)]
+    payloads = []
+    for b in range(n):
+        idx = [b % 40 - 20, b // 40 % 40 - 20, b // 1600]
+        payloads.append(json.dumps({
+            'index': idx,
+            'timestamp': 1600000000 + b,
+            'updated': 1600000000000 + b,
+            'data': [{'data': json.dumps({"object": {"filepath": f"bundle{random.randrange(1000)}",
+                                                     "position": [random.uniform(0, 500) for _ in range(3)]}}),
+                      'signature': "%0512x" % random.getrandbits(2048),
+                      'updated': 1600000000000 + b, 'approved': True} for _ in range(b % 3)],
+            'proof': random.randrange(10 ** 6),
+            'owner': random.choice(owners),
+            'previous_hash': "%064x" % random.getrandbits(256),
+            'previous_index': idx,
+            'version': b % 7,
+        }))
+
+    def decode(build):
+        grid = {}
+        for payload in payloads:
+            block = build(json.loads(payload))
+            grid[tuple(block["index"])] = block
+        return grid
+
+    def measure(build):
+        gc.collect()
+        start = time()
+        decode(build)
+        seconds = time() - start
+        gc.collect()
+        tracemalloc.start()
+        grid = decode(build)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size, seconds
+
+    dict_size, dict_seconds = measure(lambda block: block)
+    block_size, block_seconds = measure(Block)
+    print(f"{n} blocks: dicts {dict_size / 2 ** 20:.1f}MB, decoded in {dict_seconds:.2f}s; "
+          f"Blocks {block_size / 2 ** 20:.1f}MB, decoded in {block_seconds:.2f}s; "
+          f"{1 - block_size / dict_size:.0%} less memory")
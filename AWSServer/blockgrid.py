@@ -2,134 +2,514 @@ import hashlib
 import json
 import math
 import requests
-import pickle
+import mmap
+import os
+import struct
 import sys
+import threading
+import traceback
+import zlib
 
-import boto3
-from boto3.dynamodb.conditions import Key, Attr
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 
 from time import time, sleep
 from urllib.parse import urlparse
 
-from sign import verify
+from block import Block, Record, Transaction, as_block, as_blocks
+from cache import HashCache, LazyGrid, SignatureCache, ValidationLedger
+from merkle import MerkleGrid
+from mining import Miner
+from spatial import SpatialIndex
+from storage import DynamoDBStorage
+from verification import Verifier
+from wire import accept_headers, read_response
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Stored payloads start with FORMAT_MAGIC, a format version and the codec the rest is compressed with
+FORMAT_MAGIC = b"KG"
+FORMAT_VERSION = 1
+CODEC_ZLIB = 0
+CODEC_ZSTD = 1
+
+# Snapshot files start with SNAPSHOT_HEADER (magic, format version, block count) followed by one
+# SNAPSHOT_RECORD (index, version, log start, log end, payload offset, payload length) per block
+SNAPSHOT_MAGIC = b"KGSN"
+SNAPSHOT_HEADER = struct.Struct("<4sBI")
+SNAPSHOT_RECORD = struct.Struct("<iiiqqqQI")
+
+# DynamoDB items are limited to 400KB, leave room for the key and the other attributes
+CHUNK_BYTES = 400000
 
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, Decimal):
             return int(obj)
+        if isinstance(obj, Record):
+            return obj.to_dict()
         return super(DecimalEncoder, self).default(obj)
 
 
+def parse_index(idx):
+    """
+    Parse an index that was stored as a string, eg. "(1, -2, 0)"
+    :param idx: <str> The stringified index
+    :return: <tuple> The index
+    """
+    return tuple(int(x) for x in idx.strip("()").split(","))
+
+
+def encode_payload(obj):
+    """
+    Serialize and compress something for storage. Payloads are always written with zlib, which every node can
+    read. zstd payloads are still read where zstandard is installed
+    :param obj: A JSON serializable object
+    :return: <bytes>
+    """
+    data = json.dumps(obj, cls=DecimalEncoder, separators=(",", ":")).encode("utf-8")
+    return FORMAT_MAGIC + bytes((FORMAT_VERSION, CODEC_ZLIB)) + zlib.compress(data)
+
+
+def decode_payload(payload):
+    """
+    Read something written by encode_payload, or a plain JSON string written before payloads were compressed
+    :param payload: <bytes|str> The stored payload
+    :return: The deserialized object
+    """
+    if isinstance(payload, str):
+        return json.loads(payload)
+    if payload[:2] != FORMAT_MAGIC or payload[2] != FORMAT_VERSION:
+        raise ValueError("Unknown storage format")
+    if payload[3] == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("Payload is compressed with zstd, which is not installed")
+        return json.loads(zstandard.ZstdDecompressor().decompress(payload[4:]))
+    return json.loads(zlib.decompress(payload[4:]))
+
+
+def chunk_key(idx, ix):
+    return str(tuple(idx)) + "_" + str(ix)
+
+
+def header_key(idx):
+    return str(tuple(idx)) + "_header"
+
+
+def log_key(idx, seq):
+    return str(tuple(idx)) + "_log_" + str(seq)
+
+
+def parse_key(key):
+    """
+    Split the key of a stored item into the index of its block and what kind of item it is
+    :param key: <str> eg. "(0, 0, 1)_3", "(0, 0, 1)_header" or "(0, 0, 1)_log_12"
+    :return: <tuple> (index, kind, number) where kind is "chunk", "header" or "log"
+    """
+    idx, rest = key.split(")_", 1)
+    if rest == "header":
+        return parse_index(idx), "header", None
+    if rest.startswith("log_"):
+        return parse_index(idx), "log", int(rest[4:])
+    return parse_index(idx), "chunk", int(rest)
+
+
 class Blockgrid(object):
-    def __init__(self):
-        with open("accesskey", "r") as ak, open("./secretkey", "r") as sk:
-            self.dynamodb = boto3.resource('dynamodb', endpoint_url="https://dynamodb.us-east-2.amazonaws.com",
-                                           region_name='us-east-2',
-                                           aws_access_key_id=ak.read(),
-                                           aws_secret_access_key=sk.read())
-        self.table = self.dynamodb.Table('Grid')
-        self.dynamodb_client = boto3.client('dynamodb', region_name='us-east-2')
-        self.grid = self.load_grid()
+    def __init__(self, storage=None, compact_every=32, write_behind=None, snapshot=None, cache_size=None,
+                 hash_cache_size=100000, ledger_size=100000, signature_cache=None, signature_cache_size=100000,
+                 peer_timeout=10.0, peer_concurrency=8):
+        """
+        :param storage: <Storage> Where the grid is persisted, defaults to the DynamoDB Grid table
+        :param compact_every: <int> How many logged transactions a block collects before it is rewritten as a snapshot
+        :param write_behind: <float> If set, saves are queued and written by a background thread after this many
+                             seconds, merging repeated saves of a block. Call flush() before shutting down
+        :param snapshot: <str> A snapshot file written by save() to start from, if it exists
+        :param cache_size: <int> If set, blocks are read from storage when they are first used and at most this
+                           many are kept in memory. The snapshot is not used in this case
+        :param hash_cache_size: <int> How many block hashes are remembered
+        :param ledger_size: <int> How many blocks are remembered as verified, so they are not checked again
+        :param signature_cache: <str> A file verified signatures are remembered in across restarts, see
+                                SignatureCache. Call self.verifier.cache.save() to write it
+        :param signature_cache_size: <int> How many verified signatures are remembered
+        :param peer_timeout: <float> How many seconds a peer has to connect and to send each part of its grid
+        :param peer_concurrency: <int> How many peers are fetched from at the same time
+        """
+        self.storage = storage if storage is not None else DynamoDBStorage()
+        self.compact_every = compact_every
+        self.write_behind = write_behind
+        self.write_stats = {"saves": 0, "coalesced": 0, "flushed": 0, "failures": 0}
+        self.hashes = HashCache(hash_cache_size)
+        self.ledger = ValidationLedger(ledger_size)
+        self.merkle = MerkleGrid(self.block_digest)
+        self.spatial = SpatialIndex(lambda idx: self.grid.get(idx))
+        # Every change to a block gets the next sequence number, so peers can ask for the changes after the last
+        # one they saw. The epoch tells them when the numbering has started over
+        self.epoch = os.urandom(8).hex()
+        self.change_seq = 0
+        self.changes = {}
+        self.change_lock = threading.Lock()
+        self.dirty = {}
+        self.dirty_lock = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.append_lock = threading.Lock()
+        self.load_stats = {}
+        # The [start, end) range of each block's transaction log that is not part of its snapshot
+        self.logs = {}
+        if cache_size is not None:
+            start = time()
+            self.grid = LazyGrid(self.read_block, self.stored_versions(), cache_size, lambda idx: idx in self.dirty)
+            self.load_stats = {'blocks': len(self.grid), 'seconds': time() - start}
+        elif snapshot is not None and os.path.isfile(snapshot):
+            self.grid = self.load(snapshot)
+        else:
+            self.grid = self.load_grid()
         self.nodes = set()
+        self.peer_timeout = peer_timeout
+        self.peer_concurrency = peer_concurrency
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=peer_concurrency))
+        self.peer_stats = {}
+        # The ETag of the last grid fetched from each peer, a peer whose grid has not changed sends nothing back
+        self.peer_etags = {}
+        self.peer_lock = threading.Lock()
+        # The (epoch, sequence number) each peer was last synced to
+        self.sync_marks = {}
         self.asset_bundles = dict()
+        self.miner = Miner()
+        self.verifier = Verifier(cache=SignatureCache(signature_cache_size, signature_cache))
+
+        self.merkle.reset(self.grid)
+        self.spatial.reset(self.grid)
 
         # Create the genesis block
         if len(self.grid) == 0:
             self.new_block(previous_hash=0, index=(0, 0, 0), previous_index=(0, 0, 0))
 
+        if self.write_behind is not None:
+            threading.Thread(target=self.flush_loop, daemon=True).start()
+
     def load_grid(self):
         """
-        Read the grid from dynamodb
+        Read the grid from storage
         :return: <dict> The grid
         """
+        start = time()
+        items = self.storage.scan()
+        stored = {}
+        for item in items:
+            idx, kind, n = parse_key(item["index"])
+            parts = stored.setdefault(idx, {"chunk": {}, "header": None, "log": {}})
+            if kind == "header":
+                parts["header"] = item
+            else:
+                parts[kind][n] = item
+
         grid = {}
-        for i in range(10):
-            for j in range(10):
-                for k in range(10):
-                    block = ""
-                    ix = 0
-                    while True:
-                        out = self.persistent_query(Key('index').eq(str((i, j, k)) + "_" + str(ix)))['Items']
-                        if len(out) == 0:
-                            break
-                        block += out[0]["block"]
-                        ix += 1
-
-                    if len(block) > 0:
-                        grid[(i, j, k)] = json.loads(block)
-                        if "version" not in grid[(i, j, k)]:
-                            grid[(i, j, k)]["version"] = 0
+        for idx, parts in stored.items():
+            block = self.assemble_block(idx, parts["chunk"], parts["header"], parts["log"].get)
+            if block is not None:
+                grid[idx] = block
+
+        self.load_stats = {
+            'items': len(items),
+            'blocks': len(grid),
+            'seconds': time() - start,
+        }
         return grid
 
+    def assemble_block(self, idx, chunks, header, read_log):
+        """
+        Rebuild a block from its snapshot, its header and the transactions logged since the snapshot
+        :param idx: <tuple> The index of the block
+        :param chunks: <dict> The stored snapshot chunks by number
+        :param header: <dict> The stored header, None for blocks written before headers existed
+        :param read_log: <function> Returns the stored log entry with a given sequence number, or None
+        :return: <Block> The block, or None if nothing is stored for it
+        """
+        # The snapshot is the run of chunks starting at 0 that were written together
+        snapshot = []
+        ix = 0
+        while ix in chunks and chunks[ix]["version"] == chunks[0]["version"] and \
+                type(chunks[ix]["block"]) is type(chunks[0]["block"]):
+            snapshot.append(chunks[ix]["block"])
+            ix += 1
+        if len(snapshot) == 0 and header is None:
+            return None
+
+        if len(snapshot) == 0:
+            block = {"data": []}
+        elif isinstance(snapshot[0], str):
+            block = decode_payload("".join(snapshot))
+        else:
+            block = decode_payload(b"".join(snapshot))
+        log_start = block.pop("log_start", 0)
+        block = Block(block)
+        if header is not None:
+            self.apply_header(block, header)
+        elif "version" not in block:
+            block["version"] = 0
+
+        self.logs[idx] = [log_start, log_start]
+        self.read_log(idx, block, read_log)
+        return block
+
+    @staticmethod
+    def apply_header(block, header):
+        """
+        Overwrite everything but the data of a block with a stored header
+        :param block: <dict> The block
+        :param header: <dict> The stored header item
+        :return: <int> The log position of the snapshot the header belongs to
+        """
+        fields = json.loads(header["block"])
+        log_start = fields.pop("log_start")
+        block.update(fields)
+        block["version"] = header["version"]
+        return log_start
+
+    def read_log(self, idx, block, read_log):
+        """
+        Append the transactions logged after the end of a block's known log
+        :param idx: <tuple> The index of the block
+        :param block: <dict> The block
+        :param read_log: <function> Returns the stored log entry with a given sequence number, or None
+        """
+        seq = self.logs[idx][1]
+        while True:
+            out = read_log(seq)
+            if out is None:
+                break
+            block["data"].append(Transaction(decode_payload(out["block"])))
+            seq += 1
+        self.logs[idx][1] = seq
+
     def refresh_index(self, idx):
         """
-        Read the data for a specific index from dynamodb
+        Read the data for a specific index from storage. If the block has not been compacted since it was
+        last read only its header and new log entries are fetched. The block only counts as changed, eg. for ETags,
+        if its version or log moved
         :param: <tuple> The index being refreshed
         """
-        block = ""
+        before = self.block_state(idx)
+        self.read_index(idx)
+        if before is None or self.block_state(idx) != before:
+            self.mark_changed(idx)
+
+    def block_state(self, idx):
+        """
+        :param idx: <tuple> The index of a block
+        :return: <tuple> The version and log range of the block held in memory, or None if it is not in memory
+        """
+        if idx not in self.grid or (isinstance(self.grid, LazyGrid) and not self.grid.cached(idx)):
+            return None
+        return self.grid[idx].get("version"), tuple(self.logs.get(idx, ()))
+
+    def read_index(self, idx):
+        # A lazily loaded block that is not in memory is simply read again
+        if isinstance(self.grid, LazyGrid) and not self.grid.cached(idx):
+            self.grid.invalidate(idx)
+            self.grid.get(idx)
+            return
+
+        header = self.storage.get(header_key(idx))
+        if header is not None and idx in self.grid and idx in self.logs and \
+                json.loads(header["block"])["log_start"] == self.logs[idx][0]:
+            self.apply_header(self.grid[idx], header)
+            self.read_log(idx, self.grid[idx], lambda seq: self.storage.get(log_key(idx, seq)))
+            return
+
+        block = self.read_block(idx, header)
+        if block is not None:
+            self.grid[idx] = block
+
+    def read_block(self, idx, header=None):
+        """
+        Read a whole block from storage
+        :param idx: <tuple> The index of the block
+        :param header: <dict> The stored header of the block if it has already been read
+        :return: <Block> The block, or None if it is not stored
+        """
+        if header is None:
+            header = self.storage.get(header_key(idx))
+
+        chunks = {}
         ix = 0
-        version = 0
         while True:
-            out = self.persistent_query(Key('index').eq(str(idx) + "_" + str(ix)))['Items']
-            if len(out) == 0:
+            out = self.storage.get(chunk_key(idx, ix))
+            if out is None:
                 break
-            block += out[0]["block"]
+            chunks[ix] = out
             ix += 1
-            version = out[0]["version"]
 
-        if len(block) > 0:
-            self.grid[idx] = json.loads(block)
-            self.grid[idx]["version"] = version
+        return self.assemble_block(idx, chunks, header, lambda seq: self.storage.get(log_key(idx, seq)))
+
+    def mark_changed(self, idx):
+        """
+        Record that the block at idx has changed, for the Merkle tree, the spatial index and for peers syncing
+        changes
+        :param idx: <tuple> The index of the block
+        """
+        self.merkle.update(idx)
+        self.spatial.update(idx)
+        with self.change_lock:
+            self.change_seq += 1
+            self.changes[tuple(idx)] = self.change_seq
+
+    def save_header(self, idx):
+        """
+        Save everything about a block except its data, bumping its version
+        :param idx: <tuple> The index of the block
+        :return: <bool> True if the header was saved, False if the block was changed in storage in the meantime
+        """
+        self.hashes.invalidate(idx)
+        self.mark_changed(idx)
+        if self.write_behind is not None:
+            self.mark_dirty(idx, None)
+            return True
+        return self.write_header(idx)
 
     def save_block(self, idx, block):
         """
-        Save a block to dynamodb
+        Save a whole block to storage as a new snapshot, folding in its transaction log
         :param idx: <tuple> The index of the block being saved
-        :param block: <string> The contents of the block being saved
-        :return:
+        :param block: <dict> The contents of the block being saved
+        :return: <bool> True if the block was saved, False if it was changed in storage in the meantime
         """
-        x = 400000 // 4
-        block = json.dumps(block, cls=DecimalEncoder)
-        chunks = [block[y - x:y] for y in range(x, len(block) + x, x)]
-        ix = 0
-        version = self.grid[idx]["version"]
-        success = True
+        self.hashes.invalidate(idx)
+        self.mark_changed(idx)
+        if self.write_behind is not None:
+            self.mark_dirty(idx, block)
+            return True
+        return self.write_block(idx, block)
 
-        for chunk in chunks:
-            success = self.persistent_put({"index": str(idx) + "_" + str(ix), "block": chunk, "version": version + 1}, version)
-            ix += 1
-            sleep(1.0)
-            if not success:
-                break
+    def write_header(self, idx):
+        block = self.grid[idx]
+        version = block["version"]
+        header = {k: v for k, v in block.items() if k != "data" and k != "version"}
+        header["log_start"] = self.logs.setdefault(idx, [0, 0])[0]
+        success = self.storage.put({"index": header_key(idx), "block": json.dumps(header, cls=DecimalEncoder),
+                                    "version": version + 1}, version)
         if success:
-            self.grid[idx]["version"] += 1
+            block["version"] = version + 1
         return success
 
-    def persistent_put(self, item, previous_version):
-        result = None
-        while result is None:
+    def write_block(self, idx, block, deletes=None):
+        """
+        Write a block's header and snapshot in one go
+        :param idx: <tuple> The index of the block being saved
+        :param block: <dict> The contents of the block being saved
+        :param deletes: <list> Collects the keys of the compacted log entries, which are deleted right away if None
+        :return: <bool> True if the block was saved, False if it was changed in storage in the meantime
+        """
+        # Transactions appended while the snapshot is taken would end up in it twice
+        with self.append_lock:
+            version = block.get("version", 0)
+            log_start, log_end = self.logs.setdefault(idx, [0, 0])
+            header = {k: v for k, v in block.items() if k != "data" and k != "version"}
+            header["log_start"] = log_end
+            snapshot = encode_payload(dict(block, data=list(block["data"]), log_start=log_end))
+        items = [{"index": header_key(idx), "block": json.dumps(header, cls=DecimalEncoder), "version": version + 1}]
+
+        x = CHUNK_BYTES
+        chunks = [snapshot[y - x:y] for y in range(x, len(snapshot) + x, x)]
+        for ix, chunk in enumerate(chunks):
+            items.append({"index": chunk_key(idx, ix), "block": chunk, "version": version + 1})
+
+        # The header is what concurrent writers conflict on
+        if not self.storage.write_many(items, (header_key(idx), version)):
+            return False
+
+        # The logged transactions are part of the snapshot now
+        keys = [log_key(idx, seq) for seq in range(log_start, log_end)]
+        if deletes is None:
+            self.storage.delete_many(keys)
+        else:
+            deletes += keys
+        self.logs[idx][0] = log_end
+        block["version"] = version + 1
+        return True
+
+    def mark_dirty(self, idx, block):
+        """
+        Queue a save for the write behind thread, merging it with any save of the same index already queued
+        :param idx: <tuple> The index of the block
+        :param block: <dict> The block to snapshot, or None if only its header changed
+        """
+        with self.dirty_lock:
+            self.write_stats["saves"] += 1
+            if idx in self.dirty:
+                self.write_stats["coalesced"] += 1
+            # A queued snapshot already covers the header
+            if block is not None or idx not in self.dirty:
+                self.dirty[idx] = block
+            self.dirty_lock.notify()
+
+    def flush(self):
+        """
+        Write every queued save to storage. Waits for a flush that is already running, so once this returns
+        everything saved before the call is stored. If a write fails the saves that were not written are queued
+        again before the error is raised
+        """
+        with self.flush_lock:
+            with self.dirty_lock:
+                pending, self.dirty = self.dirty, {}
+
+            deletes = []
+            written = 0
             try:
-                self.table.put_item(Item=item, ConditionExpression=Attr('version').eq(previous_version) |
-                                                                   Attr('version').not_exists())
-            except self.dynamodb_client.exceptions.ProvisionedThroughputExceededException:
-                sleep(1.0)
-                continue
-            except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
-                return False
-            result = True
-        return result
+                for idx, block in pending.items():
+                    target = block if block is not None else self.grid[idx]
+                    while not (self.write_block(idx, block, deletes) if block is not None else
+                               self.write_header(idx)):
+                        # The caller was told the save succeeded, so the last writer wins
+                        target["version"] = self.storage.get(header_key(idx))["version"]
+                    written += 1
+                self.storage.delete_many(deletes)
+            except Exception:
+                with self.dirty_lock:
+                    self.write_stats["failures"] += 1
+                    for idx, block in list(pending.items())[written:]:
+                        # Saves queued in the meantime are newer, unless they only cover the header
+                        if idx not in self.dirty or (block is not None and self.dirty[idx] is None):
+                            self.dirty[idx] = block
+                raise
 
-    def persistent_query(self, kce):
-        result = None
-        while result is None:
+            with self.dirty_lock:
+                self.write_stats["flushed"] += len(pending)
+
+    def flush_loop(self):
+        while True:
+            with self.dirty_lock:
+                while len(self.dirty) == 0:
+                    self.dirty_lock.wait()
+            # Give repeated saves of the same blocks a chance to pile up
+            sleep(self.write_behind)
             try:
-                result = self.table.query(KeyConditionExpression=kce)
-            except self.dynamodb_client.exceptions.ProvisionedThroughputExceededException:
-                sleep(1.0)
-                pass
-        return result
+                self.flush()
+            except Exception:
+                # The failed saves are queued again and retried on the next round
+                traceback.print_exc()
+
+    def stats(self):
+        """
+        Counters describing how the grid has been loaded and stored
+        :return: <dict>
+        """
+        return {
+            'load': self.load_stats,
+            'storage': self.storage.stats(),
+            'writes': dict(self.write_stats),
+            'cache': self.grid.stats() if isinstance(self.grid, LazyGrid) else {},
+            'hashes': self.hashes.stats(),
+            'validation': self.ledger.stats(),
+            'signatures': self.verifier.cache.stats(),
+            'spatial': self.spatial.stats(),
+            'peers': self.peers(),
+        }
 
     def new_block(self, index, previous_hash, previous_index):
         """
@@ -137,10 +517,10 @@ class Blockgrid(object):
         :param index: <int> The index of the block being added
         :param previous_hash: <str> Hash of the previous Block
         :param previous_index: <tuple> Index of the previous Block
-        :return: <dict> New Block
+        :return: <Block> New Block
         """
 
-        block = {
+        block = Block({
             'index': tuple(index),
             'timestamp': int(time()),
             'updated': int(time()),
@@ -150,7 +530,7 @@ class Blockgrid(object):
             'previous_hash': previous_hash,
             'previous_index': tuple(previous_index),
             'version': 0,
-        }
+        })
 
         self.grid[index] = block
         self.save_block(index, block)
@@ -158,27 +538,44 @@ class Blockgrid(object):
 
     def new_transaction(self, index, data, signature, millis, approved):
         """
-        Creates a new transaction to go into the next mined Block
+        Creates a new transaction to go into the next mined Block. Only the transaction itself and the
+        block's header are written, the block is compacted into a snapshot every compact_every transactions
         :param index: <str> Index of the block
         :param data: <str> Data being stored in the block
         :param signature: <str> Signature of the owner of the block
         :return: <int> The index of the Block that will hold this transaction
         """
+        transaction = Transaction({
+            'data': data,
+            'signature': signature,
+            'updated': millis,
+            'approved': approved,
+        })
 
+        # Claim the next free slot in the block's log
         while True:
-            self.grid[index]["data"].append({
-                'data': data,
-                'signature': signature,
-                'updated': millis,
-                'approved': approved,
-            })
+            seq = self.logs.setdefault(index, [0, 0])[1]
+            key = log_key(index, seq)
+            if self.storage.insert({"index": key, "block": encode_payload(transaction), "version": 0}):
+                # The slot is free again if another node compacted past it since we last read the block, readers
+                # skip entries before the snapshot so the transaction would be lost
+                header = self.storage.get(header_key(index))
+                if header is None or json.loads(header["block"])["log_start"] <= seq:
+                    break
+                self.storage.delete_many([key])
+            self.refresh_index(index)
 
-            self.grid[index]["updated"] = millis
-            success = self.save_block(index, self.grid[index])
-            if success:
-                self.grid[index]["version"] += 1
-                break
+        with self.append_lock:
+            self.grid[index]["data"].append(transaction)
+            self.logs[index][1] = seq + 1
+
+        self.grid[index]["updated"] = millis
+        while not self.save_header(index):
             self.refresh_index(index)
+            self.grid[index]["updated"] = millis
+
+        if self.logs[index][1] - self.logs[index][0] >= self.compact_every:
+            self.save_block(index, self.grid[index])
 
         return index
 
@@ -192,7 +589,7 @@ class Blockgrid(object):
         """
         self.grid[index]["owner"] = owner
         self.grid[index]["proof"] = proof
-        self.save_block(index, self.grid[index])
+        self.save_header(index)
         previous_hash = self.hash(self.grid[index])
 
         # Add adjacent unsigned blocks
@@ -220,7 +617,11 @@ class Blockgrid(object):
         :param other_grid: <dict> The new grid
         :return: None
         """
-        self.grid = other_grid
+        self.grid = as_blocks(other_grid)
+        self.hashes.invalidate()
+        self.merkle.reset(self.grid)
+        self.spatial.reset(self.grid)
+        self.new_epoch()
 
     def update_grid(self, longer_grid, shorter_grid):
         """
@@ -244,48 +645,98 @@ class Blockgrid(object):
                             self.save_block(idx, longer_grid[idx])
             # If the block is not in our grid, but is in the shorter valid grid
             else:
-                longer_grid[idx] = block
-                self.save_block(idx, block)
+                longer_grid[idx] = as_block(block)
+                self.save_block(idx, longer_grid[idx])
         return longer_grid
 
-    def valid_gird(self, other_grid):
+    def valid_gird(self, other_grid, full=False, previous=None):
         """
-        Determine if a given Blockgrid is valid
+        Determine if a given Blockgrid is valid. The links between blocks are always checked, but the proof and
+        signatures of a block are only checked if the same block has not been verified before. The signatures
+        are checked last, all together on the verifier's processes
         :param other_grid: <list> A Blockgrid
+        :param full: <bool> Check every block again, eg. for an audit
+        :param previous: <dict> Where blocks linked to that are not in other_grid are looked up, eg. our own grid
+                         when other_grid only holds a peer's changes
         :return: <bool> True if valid, False if not
         """
 
+        unverified = []
+        signatures = []
         for k, v in other_grid.items():
             block = v
 
+            # The proof and the ledger go by the block's own index, a block moved to another index proves nothing
+            if tuple(block["index"]) != tuple(k):
+                return False
+
             if tuple(block["index"]) == (0, 0, 0):
                 continue
 
             prev = tuple(block["previous_index"])
+            if prev in other_grid:
+                prev_block = other_grid[prev]
+            elif previous is not None and prev in previous:
+                prev_block = previous[prev]
+            else:
+                return False
             # Check that the hash of the block is correct
-            if block['previous_hash'] != self.hash(other_grid[prev]):
+            if block['previous_hash'] != self.hash(prev_block):
                 return False
 
             # If the block has no owner we're done
             if block['owner'] is None and len(block["data"]) == 0:
                 continue
 
+            identity = self.block_identity(block)
+            if not full and identity in self.ledger:
+                continue
+
             # Check that the Proof of Work is correct
             if not self.valid_proof(self.hash_without_proof(block), block['proof'], k):
+                self.ledger.discard(identity)
                 return False
 
-            for d in block["data"]:
-                if not verify(block["owner"], d["data"], d["signature"]):
-                    return False
+            unverified.append(identity)
+            signatures += [(block["owner"], d["data"], d["signature"]) for d in block["data"]]
 
+        if not self.verifier.verify(signatures):
+            for identity in unverified:
+                self.ledger.discard(identity)
+            return False
+
+        for identity in unverified:
+            self.ledger.add(identity)
         return True
 
-    def compare_grids(self, other_grid):
+    def block_identity(self, block):
+        """
+        :param block: <dict> Block
+        :return: <tuple> (index, version, header hash, data digest) of the block
+        """
+        data = json.dumps(block["data"], sort_keys=True, cls=DecimalEncoder).encode()
+        return tuple(block["index"]), block.get("version"), self.hash(block), hashlib.sha256(data).hexdigest()
+
+    def block_digest(self, idx):
+        """
+        The digest of everything in a block except its version, which differs between nodes with their own storage
+        :param idx: <tuple> The index of the block
+        :return: <str> The digest, or None if there is no block at idx
+        """
+        try:
+            block = self.grid[idx]
+        except KeyError:
+            return None
+        fields = json.dumps({k: v for k, v in block.items() if k != "version"}, sort_keys=True, cls=DecimalEncoder)
+        return hashlib.sha256(fields.encode()).hexdigest()
+
+    def compare_grids(self, other_grid, full=False):
         """
         Compares two grids to determine if ours is authoritative
+        :param full: <bool> Check every block of the other grid again, eg. for an audit
         :return: <bool> True if the other grid is authoritative, False if not
         """
-        if self.valid_gird(other_grid) and len(other_grid) > len(self.grid):
+        if self.valid_gird(other_grid, full) and len(other_grid) > len(self.grid):
             return True
         return False
 
@@ -296,19 +747,18 @@ class Blockgrid(object):
         :return: <bool> True if our chain was replaced, False if not
         """
 
-        neighbours = self.nodes
+        neighbours = list(self.nodes)
         new_grid = None
 
         # We're only looking for chains longer than ours
         max_length = len(self.grid)
 
-        # Grab and verify the chains from all the nodes in our network
-        for node in neighbours:
-            response = requests.get(f'http://{node}/chain')
-
-            if response.status_code == 200:
-                length = response.json()['length']
-                grid = response.json()['grid']
+        # Grab the chains from all the nodes in our network at once, verifying each as it arrives
+        with ThreadPoolExecutor(max_workers=max(1, min(self.peer_concurrency, len(neighbours)))) as executor:
+            for future in as_completed([executor.submit(self.fetch_grid, node) for node in neighbours]):
+                if future.result() is None:
+                    continue
+                length, grid = future.result()
 
                 if self.compare_grids(grid):
                     if length > max_length:
@@ -320,45 +770,232 @@ class Blockgrid(object):
 
         # Replace our chain if we discovered a new, valid chain longer than ours
         if new_grid:
-            self.grid = new_grid
+            self.grid = as_blocks(new_grid)
+            self.hashes.invalidate()
+            self.merkle.reset(self.grid)
+            self.spatial.reset(self.grid)
+            self.new_epoch()
             return True
 
         return False
 
+    def fetch_grid(self, node):
+        """
+        Download the grid of a peer, recording how long it took or that it failed
+        :param node: <str> Address of the peer, eg. '192.168.0.5:5000'
+        :return: <tuple> The length of the peer's grid and the grid, or None if it could not be fetched or has not
+                 changed since it was last fetched
+        """
+        start = time()
+        result = None
+        unchanged = False
+        headers = accept_headers()
+        with self.peer_lock:
+            if node in self.peer_etags:
+                headers['If-None-Match'] = self.peer_etags[node]
+        try:
+            # Peers that support it send their grid in the compact binary format
+            response = self.session.get(f'http://{node}/grid', timeout=self.peer_timeout, headers=headers)
+            unchanged = response.status_code == 304
+            if response.status_code == 200:
+                values = read_response(response, ['grid'])
+                result = values['length'], values['grid']
+                if 'ETag' in response.headers:
+                    with self.peer_lock:
+                        self.peer_etags[node] = response.headers['ETag']
+        except (requests.RequestException, ValueError, KeyError, AttributeError, TypeError):
+            pass
+        seconds = time() - start
+
+        with self.peer_lock:
+            stats = self.peer_stats.setdefault(node, {'requests': 0, 'failures': 0, 'unchanged': 0, 'seconds': 0.0,
+                                                      'last': None})
+            stats['requests'] += 1
+            stats['unchanged'] += unchanged
+            stats['failures'] += result is None and not unchanged
+            stats['seconds'] += seconds
+            stats['last'] = seconds
+        return result
+
+    def etag(self, idx=None):
+        """
+        A tag that changes whenever the grid changes, without looking at the blocks
+        :param idx: <tuple> Only change the tag when the block at idx changes
+        :return: <str>
+        """
+        with self.change_lock:
+            if idx is None:
+                return f"{self.epoch}-{self.change_seq}"
+            return f"{self.epoch}-{self.changes.get(tuple(idx), 0)}"
+
+    def new_epoch(self):
+        """
+        Start numbering changes over, eg. after the grid was replaced, so peers fetch the whole grid again
+        """
+        with self.change_lock:
+            self.epoch = os.urandom(8).hex()
+            self.change_seq = 0
+            self.changes = {}
+
+    def changes_since(self, since=None, epoch=None, versions=None):
+        """
+        Find the blocks a peer has not seen yet
+        :param since: <int> The last change number the peer saw
+        :param epoch: <str> The epoch since is from. If it is not ours the peer is sent the whole grid
+        :param versions: <dict> (version, updated) of each block the peer has, updated may be None. If given the
+                         peer is sent the blocks it does not have and those with a newer version or update
+        :return: <dict> The blocks, our epoch and the high water mark to pass as since next time
+        """
+        with self.change_lock:
+            current, high_water, changes = self.epoch, self.change_seq, dict(self.changes)
+
+        full = versions is None and (since is None or epoch != current)
+        if versions is not None:
+            blocks = {}
+            for idx, block in list(self.grid.items()):
+                known = versions.get(idx)
+                if known is None or block.get("version", 0) > known[0] or \
+                        (known[1] is not None and block["updated"] > known[1]):
+                    blocks[idx] = block
+        elif full:
+            blocks = dict(self.grid.items())
+        else:
+            blocks = {idx: self.grid[idx] for idx, seq in changes.items() if seq > since and idx in self.grid}
+        return {'grid': blocks, 'epoch': current, 'high_water': high_water, 'full': full}
+
+    def sync_changes(self, node):
+        """
+        Fetch the blocks a peer has changed since we last synced with it and merge them into our grid the same
+        way update_grid does
+        :param node: <str> Address of the peer, eg. '192.168.0.5:5000'
+        :return: <int> The number of blocks received, or None if the peer could not be synced with
+        """
+        mark = self.sync_marks.get(node)
+        body = {} if mark is None else {'epoch': mark[0], 'since': mark[1]}
+        try:
+            response = self.session.get(f'http://{node}/grid/changes', json=body, timeout=self.peer_timeout,
+                                        headers=accept_headers())
+            if response.status_code != 200:
+                return None
+            values = read_response(response, ['grid'])
+            changes = values['grid']
+        except (requests.RequestException, ValueError, KeyError, AttributeError, TypeError):
+            return None
+
+        if not self.valid_gird(changes, previous=self.grid):
+            return None
+        self.update_grid(self.grid, changes)
+        self.sync_marks[node] = (values['epoch'], values['high_water'])
+        return len(changes)
+
+    def peers(self):
+        """
+        :return: <dict> Requests, failures, unchanged grids, total and last latency in seconds of each peer grids
+                 were fetched from
+        """
+        with self.peer_lock:
+            return {node: dict(stats) for node, stats in self.peer_stats.items()}
+
     def save(self, filename):
-        with open(filename, "wb") as f:
-            pickle.dump(self.grid, f, protocol=pickle.HIGHEST_PROTOCOL)
+        """
+        Write the grid to a snapshot file that load() can use to start up without reading the whole grid
+        from storage. The file starts with a table of fixed size records, one per block, holding the index,
+        version, log position and location of the block's payload, followed by the payloads
+        :param filename: <str> Path of the snapshot file
+        """
+        with self.append_lock:
+            blocks = [(idx, block, list(self.logs.get(idx, [0, 0])), encode_payload(block))
+                      for idx, block in list(self.grid.items())]
+
+        offset = SNAPSHOT_HEADER.size + SNAPSHOT_RECORD.size * len(blocks)
+        with open(filename + ".tmp", "wb") as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, FORMAT_VERSION, len(blocks)))
+            for idx, block, log, payload in blocks:
+                f.write(SNAPSHOT_RECORD.pack(*idx, int(block["version"]), log[0], log[1], offset, len(payload)))
+                offset += len(payload)
+            for _, _, _, payload in blocks:
+                f.write(payload)
+        # Never leave a half written snapshot behind
+        os.replace(filename + ".tmp", filename)
 
     def load(self, filename):
-        with open(filename, "rb") as f:
-            self.grid = pickle.load(f)
+        """
+        Read the grid from a snapshot file written by save(), then read the blocks that have changed in
+        storage since
+        :param filename: <str> Path of the snapshot file
+        :return: <dict> The grid
+        """
+        start = time()
+        grid = {}
+        self.logs = {}
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, version, count = SNAPSHOT_HEADER.unpack_from(m, 0)
+            if magic != SNAPSHOT_MAGIC or version != FORMAT_VERSION:
+                raise ValueError("Unknown snapshot format")
+            for n in range(count):
+                i, j, k, version, log_start, log_end, offset, length = \
+                    SNAPSHOT_RECORD.unpack_from(m, SNAPSHOT_HEADER.size + n * SNAPSHOT_RECORD.size)
+                grid[(i, j, k)] = Block(decode_payload(m[offset:offset + length]))
+                self.logs[(i, j, k)] = [log_start, log_end]
+        self.grid = grid
 
-    @staticmethod
-    def hash(block):
+        # Blocks written before headers existed have no version to compare with, so they are always read
+        stored = self.stored_versions()
+        changed = [idx for idx, version in stored.items()
+                   if idx not in grid or version != (grid[idx]["version"], self.log_end(idx))]
+        for idx in changed:
+            self.refresh_index(idx)
+        for idx in set(grid) - set(stored):
+            del self.grid[idx]
+            del self.logs[idx]
+
+        self.load_stats = {
+            'snapshot_blocks': count,
+            'refreshed': len(changed),
+            'blocks': len(self.grid),
+            'seconds': time() - start,
+        }
+        return self.grid
+
+    def log_end(self, idx):
+        """
+        :return: <int> Where the log of a block ends, 0 if it has no entries since its snapshot
         """
-        Creates a SHA-256 hash of a Block
+        log_start, log_end = self.logs[idx]
+        return log_end if log_end > log_start else 0
+
+    def stored_versions(self):
+        """
+        Read what version each block has in storage, without reading the blocks
+        :return: <dict> (header version, end of the log) of each block, the version is None if it has no header
+        """
+        stored = {}
+        for key, version in self.storage.versions():
+            idx, kind, n = parse_key(key)
+            header, log_end = stored.get(idx, (None, 0))
+            if kind == "header":
+                header = version
+            elif kind == "log":
+                log_end = max(log_end, n + 1)
+            stored[idx] = (header, log_end)
+        return stored
+
+    def hash(self, block):
+        """
+        Creates a SHA-256 hash of a Block, reusing the last hash of the same version of the block
         :param block: <dict> Block
         :return: <str>
         """
+        return self.hashes.get("hash", block, {k: v for k, v in block.items() if k != "data" and k != "updated"})
 
-        # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps({k: v for k, v in block.items() if k != "data" and k != "updated"},
-                                  sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
-
-    @staticmethod
-    def hash_without_proof(block):
+    def hash_without_proof(self, block):
         """
         Creates a SHA-256 hash of a Block without the proof field (used for proof-of-work)
         :param block: <dict> Block
         :return: <str>
         """
-
-        # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(
-            {k: v for k, v in block.items() if k == "owner" and k == "index" and k == "previous_hash"},
-            sort_keys=True).encode()
-        return hashlib.sha256(block_string).hexdigest()
+        return self.hashes.get("hash_without_proof", block, {
+            k: v for k, v in block.items() if k == "owner" and k == "index" and k == "previous_hash"})
 
     def last_index(self, index):
         """
@@ -373,21 +1010,19 @@ class Blockgrid(object):
         last_index = tuple(x if i != index_max else x - 1 * math.copysign(1, x) for i, x in enumerate(index))
         return last_index
 
-    def proof_of_work(self, last_proof, index):
+    def proof_of_work(self, last_proof, index, timeout=None, cancel=None):
         """
         Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains leading 4 zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
+        The search is spread over several processes for hard proofs
         :param last_proof: <int>
         :param index: <int>
-        :return: <int>
+        :param timeout: <float> Give up after this many seconds
+        :param cancel: <Event> Give up when this is set
+        :return: <int> The proof, or None if the search timed out or was cancelled
         """
-
-        proof = 0
-        while self.valid_proof(last_proof, proof, index) is False:
-            proof += 1
-
-        return proof
+        return self.miner.mine(last_proof, index, timeout, cancel)
 
     @staticmethod
     def valid_proof(last_proof, proof, index):
@@ -0,0 +1,872 @@
+import boto3
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from collections import OrderedDict
+from Crypto.PublicKey import RSA
+from decimal import Decimal
+from flask import Flask, jsonify, request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from werkzeug.serving import make_server
+
+import spatial
+import streaming
+import verification
+import wire
+from block import Block, Transaction, as_blocks, plain
+from blockgrid import CODEC_ZLIB, CODEC_ZSTD, FORMAT_MAGIC, FORMAT_VERSION, Blockgrid, decode_payload
+from cache import SignatureCache
+from capacity import CapacityManager
+from jobs import MiningJobs, QueueFull
+from mining import Miner, search
+from sign import Signer, rsakeys, sign, verify
+from storage import DynamoDBStorage, SQLiteStorage
+from streaming import stream_grid
+from verification import Verifier, signature_digest
+
+
+class StorageTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = SQLiteStorage(":memory:")
+
+    def test_conditional_put(self):
+        self.assertTrue(self.storage.put({"index": "a", "block": "1", "version": 1}, 0))
+        self.assertFalse(self.storage.put({"index": "a", "block": "2", "version": 1}, 0))
+        self.assertTrue(self.storage.put({"index": "a", "block": "3", "version": 2}, 1))
+        self.assertEqual(self.storage.get("a"), {"index": "a", "block": "3", "version": 2})
+        self.assertIsNone(self.storage.get("b"))
+
+    def test_reload_grid(self):
+        blockgrid = Blockgrid(self.storage)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((1, 0, 0), "data", "signature", 1, True)
+
+        reloaded = Blockgrid(self.storage)
+        self.assertEqual(set(reloaded.grid), set(blockgrid.grid))
+        self.assertEqual(reloaded.grid[(1, 0, 0)]["data"], blockgrid.grid[(1, 0, 0)]["data"])
+        self.assertEqual(reloaded.grid[(0, 0, 0)]["owner"], "key")
+
+
+class DynamoDBStorageTest(unittest.TestCase):
+    def setUp(self):
+        dynamodb = boto3.resource("dynamodb", region_name="us-east-2", aws_access_key_id="key",
+                                  aws_secret_access_key="secret")
+        # The bodies of the requests as they would be sent, captured before the stubbed responses replace them
+        self.sent = []
+        dynamodb.meta.client.meta.events.register_first("before-call.*.*", lambda params, **kwargs: self.sent.append(
+            json.loads(params["body"])))
+        self.stubber = Stubber(dynamodb.meta.client)
+        self.stubber.add_response("describe_table", {"Table": {"TableName": "Grid"}}, {"TableName": "Grid"})
+        self.stubber.activate()
+        self.storage = DynamoDBStorage(segments=1, dynamodb=dynamodb)
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_scan(self):
+        scan = {"TableName": "Grid", "Segment": 0, "TotalSegments": 1, "ReturnConsumedCapacity": "TOTAL"}
+        self.stubber.add_response("scan", {"Items": [{"index": {"S": "(0, 0, 0)_header"}, "version": {"N": "2"},
+                                                      "block": {"S": "{}"}}],
+                                           "LastEvaluatedKey": {"index": {"S": "(0, 0, 0)_header"}}}, scan)
+        self.stubber.add_response("scan", {"Items": [{"index": {"S": "(0, 0, 0)_0"}, "version": {"N": "2"},
+                                                      "block": {"B": b"KG"}}]},
+                                  dict(scan, ExclusiveStartKey={"index": "(0, 0, 0)_header"}))
+        self.assertEqual(self.storage.scan(), [{"index": "(0, 0, 0)_header", "version": 2, "block": "{}"},
+                                               {"index": "(0, 0, 0)_0", "version": 2, "block": b"KG"}])
+        self.stubber.assert_no_pending_responses()
+
+    def test_write_many(self):
+        items = [{"index": "(0, 0, 0)_header", "block": "{}", "version": 2},
+                 {"index": "(0, 0, 0)_0", "block": b"KG", "version": 2}]
+        self.stubber.add_response("transact_write_items", {})
+        self.assertTrue(self.storage.write_many(items, ("(0, 0, 0)_header", 1)))
+        self.assertEqual(self.sent[-1]["TransactItems"], [
+            {"Put": {"TableName": "Grid", "Item": {"index": {"S": "(0, 0, 0)_header"}, "block": {"S": "{}"},
+                                                   "version": {"N": "2"}, "listed": {"S": "(0, 0, 0)_header"}},
+                     "ConditionExpression": "attribute_not_exists(#v) OR #v = :v",
+                     "ExpressionAttributeNames": {"#v": "version"},
+                     "ExpressionAttributeValues": {":v": {"N": "1"}}}},
+            {"Put": {"TableName": "Grid", "Item": {"index": {"S": "(0, 0, 0)_0"}, "block": {"B": "S0c="},
+                                                   "version": {"N": "2"}}}}])
+
+        self.stubber.add_client_error("transact_write_items", "TransactionCanceledException",
+                                      modeled_fields={"CancellationReasons": [{"Code": "ConditionalCheckFailed"}]})
+        self.assertFalse(self.storage.write_many(items, ("(0, 0, 0)_header", 1)))
+        self.stubber.assert_no_pending_responses()
+
+    def test_versions_index(self):
+        self.stubber.add_response("scan", {"Items": [{"index": {"S": "(0, 0, 0)_0"}, "version": {"N": "1"}}]})
+        self.assertEqual(self.storage.versions(), [("(0, 0, 0)_0", 1)])
+        self.assertNotIn("IndexName", self.sent[-1])
+
+        self.stubber.add_response("describe_table", {"Table": {"TableName": "Grid", "GlobalSecondaryIndexes": [
+            {"IndexName": "versions", "IndexStatus": "ACTIVE"}]}})
+        storage = DynamoDBStorage(segments=1, dynamodb=self.storage.dynamodb)
+        self.stubber.add_response("scan", {"Items": [{"index": {"S": "(0, 0, 0)_header"}, "version": {"N": "1"}}]})
+        self.assertEqual(storage.versions(), [("(0, 0, 0)_header", 1)])
+        self.assertEqual(self.sent[-1]["IndexName"], "versions")
+
+        # Headers and log entries are listed in the index, snapshot chunks are not
+        for key in ("(0, 0, 0)_header", "(0, 0, 0)_log_3", "(0, 0, 0)_0"):
+            self.stubber.add_response("put_item", {})
+            self.assertTrue(storage.put({"index": key, "block": "{}", "version": 1}))
+            self.assertEqual(self.sent[-1]["Item"].get("listed"), {"S": key} if not key.endswith("_0") else None)
+        self.stubber.add_response("query", {"Items": [{"index": {"S": "(0, 0, 0)_header"}, "version": {"N": "1"},
+                                                       "block": {"S": "{}"}, "listed": {"S": "(0, 0, 0)_header"}}]})
+        self.assertEqual(storage.get("(0, 0, 0)_header"), {"index": "(0, 0, 0)_header", "version": 1, "block": "{}"})
+        self.stubber.assert_no_pending_responses()
+
+    def test_create_versions_index(self):
+        keys = ["(0, 0, 0)_header", "(0, 0, 0)_0", "(0, 0, 0)_log_3", "(1, 0, 0)_0", "(1, 0, 0)_1"]
+        self.stubber.add_response("scan", {"Items": [{"index": {"S": key}} for key in keys]})
+        self.stubber.add_response("update_item", {})
+        self.stubber.add_client_error("update_item", "ConditionalCheckFailedException")
+        self.stubber.add_response("update_item", {})
+        self.stubber.add_response("describe_table", {"Table": {"TableName": "Grid", "ProvisionedThroughput": {
+            "ReadCapacityUnits": 5, "WriteCapacityUnits": 5}}})
+        self.stubber.add_response("update_table", {})
+        self.storage.create_versions_index()
+        self.stubber.assert_no_pending_responses()
+
+        updates = [body for body in self.sent if "UpdateExpression" in body]
+        self.assertEqual([body["Key"]["index"]["S"] for body in updates],
+                         ["(0, 0, 0)_header", "(0, 0, 0)_log_3", "(1, 0, 0)_0"])
+        self.assertEqual(self.sent[-1]["GlobalSecondaryIndexUpdates"][0]["Create"]["KeySchema"],
+                         [{"AttributeName": "listed", "KeyType": "HASH"}])
+        self.assertEqual(self.sent[-1]["GlobalSecondaryIndexUpdates"][0]["Create"]["ProvisionedThroughput"],
+                         {"ReadCapacityUnits": 5, "WriteCapacityUnits": 5})
+
+
+class TransactionLogTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = SQLiteStorage(":memory:")
+
+    @staticmethod
+    def data(blockgrid, idx):
+        return [d["data"] for d in blockgrid.grid[idx]["data"]]
+
+    def test_concurrent_appends(self):
+        node1 = Blockgrid(self.storage)
+        node2 = Blockgrid(self.storage)
+        node1.new_transaction((0, 0, 0), "a", "signature", 1, True)
+        node2.new_transaction((0, 0, 0), "b", "signature", 2, True)
+
+        self.assertEqual(self.data(node2, (0, 0, 0)), ["a", "b"])
+        self.assertEqual(self.data(Blockgrid(self.storage), (0, 0, 0)), ["a", "b"])
+        self.assertEqual(Blockgrid(self.storage).grid[(0, 0, 0)]["updated"], 2)
+
+    def test_compaction(self):
+        blockgrid = Blockgrid(self.storage, compact_every=3)
+        for i in range(4):
+            blockgrid.new_transaction((0, 0, 0), str(i), "signature", i, True)
+
+        self.assertEqual(blockgrid.logs[(0, 0, 0)], [3, 4])
+        self.assertEqual(sorted(item["index"] for item in self.storage.scan() if "_log_" in item["index"]),
+                         ["(0, 0, 0)_log_3"])
+        self.assertEqual(self.data(Blockgrid(self.storage), (0, 0, 0)), ["0", "1", "2", "3"])
+
+    def test_append_after_remote_compaction(self):
+        node1 = Blockgrid(self.storage)
+        node2 = Blockgrid(self.storage, compact_every=3)
+        node1.new_transaction((0, 0, 0), "a1", "signature", 1, True)
+        for i in range(4):
+            node2.new_transaction((0, 0, 0), f"b{i}", "signature", 2 + i, True)
+
+        # node1 still thinks slot 1 is the next free one, but node2 compacted past it
+        node1.new_transaction((0, 0, 0), "a2", "signature", 10, True)
+        expected = ["a1", "b0", "b1", "b2", "b3", "a2"]
+        self.assertEqual(self.data(node1, (0, 0, 0)), expected)
+        self.assertEqual(self.data(Blockgrid(self.storage), (0, 0, 0)), expected)
+        self.assertIsNone(self.storage.get("(0, 0, 0)_log_1"))
+
+    def test_legacy_block(self):
+        block = {"index": [0, 0, 0], "timestamp": 0, "updated": 0, "data": [], "proof": None, "owner": None,
+                 "previous_hash": 0, "previous_index": [0, 0, 0], "version": 0}
+        self.storage.put({"index": "(0, 0, 0)_0", "block": json.dumps(block), "version": 4}, 0)
+
+        blockgrid = Blockgrid(self.storage)
+        blockgrid.new_transaction((0, 0, 0), "a", "signature", 1, True)
+        self.assertEqual(self.data(Blockgrid(self.storage), (0, 0, 0)), ["a"])
+
+    def test_compressed_snapshot(self):
+        blockgrid = Blockgrid(self.storage, compact_every=1)
+        blockgrid.new_transaction((0, 0, 0), json.dumps({str(i): {"filepath": "bundle"} for i in range(1000)}),
+                                  "signature", 1, True)
+
+        chunk = self.storage.get("(0, 0, 0)_0")["block"]
+        self.assertIsInstance(chunk, bytes)
+        # Nodes without zstandard share the table, so nothing is written with zstd
+        self.assertEqual(chunk[3], CODEC_ZLIB)
+        self.assertLess(len(chunk), len(blockgrid.grid[(0, 0, 0)]["data"][0]["data"]) // 4)
+        self.assertEqual(Blockgrid(self.storage).grid[(0, 0, 0)]["data"], blockgrid.grid[(0, 0, 0)]["data"])
+
+    @unittest.skipIf(wire.zstandard is None, "zstandard is not installed")
+    def test_zstd_payload(self):
+        compressed = wire.zstandard.ZstdCompressor().compress(b'{"a":1}')
+        payload = FORMAT_MAGIC + bytes((FORMAT_VERSION, CODEC_ZSTD)) + compressed
+        self.assertEqual(decode_payload(payload), {"a": 1})
+
+
+class WriteBehindTest(unittest.TestCase):
+    def test_coalesced_saves(self):
+        storage = SQLiteStorage(":memory:")
+        blockgrid = Blockgrid(storage, compact_every=2, write_behind=60)
+        for i in range(5):
+            blockgrid.new_transaction((0, 0, 0), str(i), "signature", i, True)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+
+        self.assertEqual(len(blockgrid.dirty), 7)
+        self.assertGreater(blockgrid.write_stats["coalesced"], 0)
+        blockgrid.flush()
+        self.assertEqual(len(blockgrid.dirty), 0)
+
+        reloaded = Blockgrid(storage)
+        self.assertEqual([d["data"] for d in reloaded.grid[(0, 0, 0)]["data"]], ["0", "1", "2", "3", "4"])
+        self.assertEqual(reloaded.grid[(0, 0, 0)]["owner"], "key")
+        self.assertEqual(set(reloaded.grid), set(blockgrid.grid))
+
+    def test_failed_flush(self):
+        storage = SQLiteStorage(":memory:")
+        blockgrid = Blockgrid(storage, write_behind=60)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        queued = set(blockgrid.dirty)
+
+        def fail(*args):
+            raise ClientError({"Error": {"Code": "InternalServerError"}}, "TransactWriteItems")
+
+        write_many = storage.write_many
+        storage.write_many = fail
+        self.assertRaises(ClientError, blockgrid.flush)
+        self.assertEqual(set(blockgrid.dirty), queued)
+        self.assertEqual(blockgrid.write_stats["failures"], 1)
+
+        storage.write_many = write_many
+        blockgrid.flush()
+        self.assertEqual(len(blockgrid.dirty), 0)
+        self.assertEqual(set(Blockgrid(storage).grid), set(blockgrid.grid))
+
+
+class SnapshotFileTest(unittest.TestCase):
+    def test_catch_up(self):
+        storage = SQLiteStorage(":memory:")
+        blockgrid = Blockgrid(storage)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((1, 0, 0), "a", "signature", 1, True)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "grid.snapshot")
+            blockgrid.save(filename)
+
+            unchanged = Blockgrid(storage, snapshot=filename)
+            self.assertEqual(unchanged.load_stats["refreshed"], 0)
+            self.assertEqual(unchanged.grid, Blockgrid(storage).grid)
+
+            blockgrid.new_transaction((1, 0, 0), "b", "signature", 2, True)
+            blockgrid.new_transaction((0, 1, 0), "c", "signature", 3, True)
+            changed = Blockgrid(storage, snapshot=filename)
+            self.assertEqual(changed.load_stats["refreshed"], 2)
+            self.assertEqual(changed.grid, Blockgrid(storage).grid)
+
+
+class LazyGridTest(unittest.TestCase):
+    def test_lru(self):
+        storage = SQLiteStorage(":memory:")
+        blockgrid = Blockgrid(storage)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((1, 0, 0), "a", "signature", 1, True)
+
+        lazy = Blockgrid(storage, cache_size=2)
+        self.assertEqual(lazy.grid.stats()["cached"], 0)
+        self.assertEqual(set(lazy.grid), set(blockgrid.grid))
+        self.assertEqual(lazy.grid[(1, 0, 0)]["data"][0]["data"], "a")
+        for idx in blockgrid.grid:
+            lazy.grid[idx]
+        lazy.grid[(1, 0, 0)]
+
+        stats = lazy.stats()["cache"]
+        self.assertEqual(stats["cached"], 2)
+        self.assertEqual(stats["hits"] + stats["misses"], len(blockgrid.grid) + 2)
+        self.assertEqual(stats["evictions"], stats["misses"] - 2)
+
+        # Evicted blocks are read again and see writes made by other nodes
+        blockgrid.new_transaction((0, 0, 0), "b", "signature", 2, True)
+        lazy.new_transaction((0, 0, 0), "c", "signature", 3, True)
+        self.assertEqual([d["data"] for d in lazy.grid[(0, 0, 0)]["data"]], ["b", "c"])
+
+
+class BlockTest(unittest.TestCase):
+    def test_block(self):
+        stored = {"index": [1, 0, 0], "timestamp": 0, "updated": 0, "proof": 5, "owner": "".join(["k", "ey"]),
+                  "previous_hash": "abc", "previous_index": [0, 0, 0], "version": 2, "extra": True,
+                  "data": [{"data": "a", "signature": "s", "updated": 1, "approved": True}]}
+        block = Block(stored)
+        self.assertEqual(block.to_dict(), dict(stored, index=(1, 0, 0), previous_index=(0, 0, 0)))
+        self.assertEqual(json.loads(json.dumps(block.to_dict())), stored)
+        self.assertIs(block["owner"], Block(dict(stored, owner="".join(["ke", "y"])))["owner"])
+        self.assertIsInstance(block["data"][0], Transaction)
+        self.assertFalse(hasattr(block, "__dict__"))
+
+        copy = block.copy()
+        copy["owner"] = None
+        del copy["extra"]
+        self.assertEqual(block["owner"], "key")
+        self.assertNotIn("extra", copy)
+        self.assertIs(copy["data"], block["data"])
+
+        del block["version"]
+        self.assertNotIn("version", block)
+        self.assertIsNone(block.get("version"))
+        self.assertRaises(KeyError, lambda: block["version"])
+
+    def test_grid_blocks(self):
+        storage = SQLiteStorage(":memory:")
+        blockgrid = Blockgrid(storage)
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((1, 0, 0), "a", "signature", 1, True)
+        for grid in (blockgrid.grid, Blockgrid(storage).grid):
+            self.assertTrue(all(isinstance(block, Block) for block in grid.values()))
+            self.assertIsInstance(grid[(1, 0, 0)]["data"][0], Transaction)
+
+        # Hashes are the same as those of the dicts blocks used to be
+        block = blockgrid.grid[(1, 0, 0)]
+        self.assertEqual(blockgrid.hash(block), Blockgrid(SQLiteStorage(":memory:")).hash(block.to_dict()))
+
+
+class HashCacheTest(unittest.TestCase):
+    def test_hash_cache(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"), hash_cache_size=2)
+        block = blockgrid.grid[(0, 0, 0)]
+        fields = json.dumps({k: v for k, v in block.items() if k != "data" and k != "updated"}, sort_keys=True)
+        expected = hashlib.sha256(fields.encode()).hexdigest()
+        self.assertEqual(blockgrid.hash(block), expected)
+        self.assertEqual(blockgrid.hash(block), expected)
+        self.assertEqual(blockgrid.hashes.stats()["hits"], 1)
+
+        # Changes are seen even when the version has not been bumped yet
+        block["owner"] = "key"
+        self.assertNotEqual(blockgrid.hash(block), expected)
+        self.assertEqual(blockgrid.hashes.stats()["misses"], 2)
+
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        self.assertEqual(blockgrid.hashes.stats()["invalidations"], 1)
+        other = dict(blockgrid.grid[(1, 0, 0)], index=[1, 0, 0], owner="other")
+        self.assertNotEqual(blockgrid.hash(other), blockgrid.hash(blockgrid.grid[(1, 0, 0)]))
+        self.assertLessEqual(blockgrid.stats()["hashes"]["cached"], 2)
+
+
+class ValidationLedgerTest(unittest.TestCase):
+    def test_incremental_validation(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        block = dict(blockgrid.grid[(1, 0, 0)], owner="key")
+        blockgrid.sign_block((1, 0, 0), blockgrid.proof_of_work(blockgrid.hash_without_proof(block), (1, 0, 0)), "key")
+
+        self.assertTrue(blockgrid.valid_gird(blockgrid.grid))
+        self.assertTrue(blockgrid.valid_gird(blockgrid.grid))
+        self.assertEqual(blockgrid.stats()["validation"]["checked"], 1)
+        self.assertEqual(blockgrid.stats()["validation"]["skipped"], 1)
+
+        self.assertTrue(blockgrid.valid_gird(blockgrid.grid, full=True))
+        self.assertEqual(blockgrid.stats()["validation"]["skipped"], 1)
+
+        # A changed block is checked again even though its version is the same
+        other = dict(blockgrid.grid)
+        other[(1, 0, 0)] = dict(other[(1, 0, 0)], proof=blockgrid.grid[(1, 0, 0)]["proof"] + 1)
+        while blockgrid.valid_proof(blockgrid.hash_without_proof(other[(1, 0, 0)]), other[(1, 0, 0)]["proof"],
+                                    (1, 0, 0)):
+            other[(1, 0, 0)]["proof"] += 1
+        self.assertFalse(blockgrid.valid_gird(other))
+
+        # A verified block copied to another index does not pass as that index's block
+        other = dict(blockgrid.grid)
+        other[(6, 0, 0)] = blockgrid.grid[(1, 0, 0)]
+        self.assertTrue(blockgrid.valid_gird(blockgrid.grid))
+        self.assertFalse(blockgrid.valid_gird(other))
+        other[(6, 0, 0)] = dict(blockgrid.grid[(0, 0, 0)], previous_index=(0, 0, 0))
+        self.assertFalse(blockgrid.valid_gird(other))
+
+
+class VerifierTest(unittest.TestCase):
+    def test_parallel_verify(self):
+        private_key, public_key = rsakeys()
+        owner = public_key.exportKey().decode()
+        signatures = [(owner, str(n).encode(), sign(private_key, str(n).encode())) for n in range(10)]
+        # A timeout of 0 leaves the chunks the workers have not finished yet to the calling process
+        for verifier in (Verifier(), Verifier(workers=2, chunk=2, parallel_signatures=1),
+                         Verifier(workers=2, chunk=2, parallel_signatures=1, timeout=0)):
+            self.assertTrue(verifier.verify(signatures))
+            self.assertTrue(verifier.verify([]))
+            self.assertFalse(verifier.verify(signatures + [(owner, b"forged", signatures[0][2])]))
+            self.assertFalse(verifier.verify([("key", b"data", b"signature")]))
+
+    def test_key_cache_size(self):
+        owners = [rsakeys()[1].exportKey().decode() for _ in range(3)]
+        size, keys = verification.KEY_CACHE_SIZE, verification.keys
+        verification.KEY_CACHE_SIZE, verification.keys = 2, OrderedDict()
+        try:
+            for owner in owners + owners[1:2]:
+                verification.load_key(owner)
+            self.assertEqual(list(verification.keys), [owners[2], owners[1]])
+        finally:
+            verification.KEY_CACHE_SIZE, verification.keys = size, keys
+
+    def test_signature_cache(self):
+        private_key, public_key = rsakeys()
+        signatures = [(public_key, str(n).encode(), sign(private_key, str(n).encode())) for n in range(3)]
+        forged = (public_key, b"forged", signatures[0][2])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "signatures")
+            verifier = Verifier(cache=SignatureCache(10, path))
+            self.assertTrue(verifier.verify(signatures))
+            self.assertFalse(verifier.verify(signatures + [forged]))
+            self.assertFalse(verifier.verify([forged]))
+            self.assertEqual(verifier.cache.stats()["hits"], 3)
+            self.assertEqual(verifier.cache.stats()["cached"], 3)
+            verifier.cache.save()
+
+            cache = SignatureCache(2, path)
+            self.assertEqual(cache.stats()["cached"], 2)
+            self.assertIn(signature_digest(*signatures[2]), cache)
+            self.assertNotIn(signature_digest(*forged), cache)
+            # Data that is not bytes never verifies, even if its text matches a verified signature
+            self.assertNotIn(signature_digest(public_key, "2", signatures[2][2]), cache)
+
+
+class MerkleTest(unittest.TestCase):
+    @staticmethod
+    def differing(ours, theirs):
+        """
+        Walk down both trees into the nodes whose digests differ, returning the blocks that differ
+        """
+        blocks = set()
+        pending = {tuple(c["node"]) for tree in (ours, theirs) for c in tree.merkle.root()["children"]}
+        while pending:
+            node = pending.pop()
+            a, b = ours.merkle.node(node), theirs.merkle.node(node)
+            if a is not None and b is not None and a["digest"] == b["digest"]:
+                continue
+            if node[0] == 0:
+                blocks.add(node[1:])
+            pending |= {tuple(c["node"]) for n in (a, b) if n is not None for c in n["children"]}
+        return blocks
+
+    def test_merkle(self):
+        storage = SQLiteStorage(":memory:")
+        ours = Blockgrid(storage)
+        ours.sign_block((0, 0, 0), 0, "key")
+        theirs = Blockgrid(storage)
+        self.assertEqual(ours.merkle.root()["digest"], theirs.merkle.root()["digest"])
+        self.assertEqual(self.differing(ours, theirs), set())
+
+        theirs.new_transaction((-1, 0, 0), "a", "signature", 1, True)
+        self.assertNotEqual(ours.merkle.root()["digest"], theirs.merkle.root()["digest"])
+        self.assertEqual(self.differing(ours, theirs), {(-1, 0, 0)})
+
+        ours.refresh_index((-1, 0, 0))
+        self.assertEqual(ours.merkle.root()["digest"], theirs.merkle.root()["digest"])
+        self.assertIsNone(ours.merkle.node((0, 5, 5, 5)))
+
+
+class SignerTest(unittest.TestCase):
+    def test_signer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = (os.path.join(directory, "private.pem"), os.path.join(directory, "public.pem"))
+
+            def save_keys():
+                private_key = RSA.generate(1024)
+                with open(paths[0], "wb") as prv_file, open(paths[1], "wb") as pub_file:
+                    prv_file.write(private_key.exportKey())
+                    pub_file.write(private_key.publickey().exportKey())
+
+            save_keys()
+            signer = Signer(*paths)
+            _, public_key = signer.keys()
+            signatures = signer.sign_many([b"a", b"b"])
+            self.assertTrue(all(verify(public_key, data, s) for data, s in zip([b"a", b"b"], signatures)))
+            self.assertIs(signer.keys()[1], public_key)
+
+            save_keys()
+            self.assertIsNot(signer.keys()[1], public_key)
+            self.assertTrue(verify(signer.keys()[1], b"c", signer.sign(b"c")))
+
+
+class PeerTest(unittest.TestCase):
+    @staticmethod
+    def serve(routes):
+        """
+        Start an HTTP server answering GET requests with routes[path](body), returning it and its address
+        """
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                if self.path not in routes:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if self.headers.get("If-None-Match") == '"grid"':
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", '"grid"')
+                self.end_headers()
+                self.wfile.write(json.dumps(routes[self.path](body)).encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, f"127.0.0.1:{server.server_port}"
+
+    @staticmethod
+    def grid_response(grid, **kwargs):
+        return dict(kwargs, grid={":".join(map(str, k)): plain(v) for k, v in grid.items()}, length=len(grid))
+
+    def test_resolve_conflicts(self):
+        theirs = Blockgrid(SQLiteStorage(":memory:"))
+        theirs.sign_block((0, 0, 0), 0, "key")
+        server, address = self.serve({"/grid": lambda body: self.grid_response(theirs.grid)})
+        try:
+            ours = Blockgrid(SQLiteStorage(":memory:"), peer_timeout=5)
+            ours.register_node(f"http://{address}")
+            ours.register_node("http://127.0.0.1:1")
+            self.assertTrue(ours.resolve_conflicts())
+            self.assertEqual(set(ours.grid), set(theirs.grid))
+
+            # Nothing is sent back once we have the peer's grid
+            self.assertFalse(ours.resolve_conflicts())
+            peers = ours.stats()["peers"]
+            self.assertEqual(peers[address]["failures"], 0)
+            self.assertEqual(peers[address]["unchanged"], 1)
+            self.assertEqual(peers["127.0.0.1:1"]["failures"], 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_sync_changes(self):
+        storage = SQLiteStorage(":memory:")
+        theirs = Blockgrid(storage)
+        theirs.sign_block((0, 0, 0), 0, "key")
+        # Start from a copy of their grid, blocks that are already in our grid only take their data from a peer
+        copy = SQLiteStorage(":memory:")
+        copy.write_many(storage.scan())
+
+        def changes(body):
+            response = theirs.changes_since(body.get("since"), body.get("epoch"))
+            return self.grid_response(response.pop("grid"), **response)
+
+        server, address = self.serve({"/grid/changes": changes})
+        try:
+            ours = Blockgrid(copy, peer_timeout=5)
+            self.assertEqual(ours.sync_changes(address), len(theirs.grid))
+            self.assertEqual(set(ours.grid), set(theirs.grid))
+            self.assertEqual(ours.sync_changes(address), 0)
+
+            # Mining a block changes it and adds its five new neighbours
+            block = dict(theirs.grid[(1, 0, 0)], owner="key")
+            theirs.sign_block((1, 0, 0), theirs.proof_of_work(theirs.hash_without_proof(block), (1, 0, 0)), "key")
+            self.assertEqual(ours.sync_changes(address), 6)
+            self.assertIn((2, 0, 0), ours.grid)
+
+            versions = {idx: (block["version"], block["updated"]) for idx, block in theirs.grid.items()}
+            self.assertEqual(theirs.changes_since(versions=versions)["grid"], {})
+            del versions[(0, 1, 0)]
+            self.assertEqual(list(theirs.changes_since(versions=versions)["grid"]), [(0, 1, 0)])
+
+            # The whole grid is sent again once the peer starts numbering its changes over
+            theirs.replace_grid(theirs.grid)
+            self.assertEqual(ours.sync_changes(address), len(theirs.grid))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class SpatialTest(unittest.TestCase):
+    def test_queries(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+
+        def place(idx, objects, approved=True):
+            data = json.dumps({name: {"filepath": name, "position": position} for name, position in objects.items()})
+            blockgrid.new_transaction(idx, data, "signature", 1, approved)
+
+        place((0, 0, 0), {"a": [490, 10, 10], "b": [100, 100, 100]})
+        place((1, 0, 0), {"c": [510, 10, 10]})
+        place((-1, 0, 0), {"d": [-510, 10, 10]}, approved=False)
+        blockgrid.new_transaction((0, 0, 0), "not json", "signature", 1, True)
+
+        def names(found):
+            return sorted(name for _, _, name, _, _ in found)
+
+        # Queries reach across blocks
+        self.assertEqual(names(blockgrid.spatial.sphere((500, 10, 10), 15)), ["a", "c"])
+        self.assertEqual(names(blockgrid.spatial.box((-600, 0, 0), (120, 120, 120))), ["b", "d"])
+        self.assertEqual([found[1:] for found in blockgrid.spatial.sphere((-510, 10, 10), 0)],
+                         [((-510, 10, 10), "d", {"filepath": "d", "position": [-510, 10, 10]}, False)])
+        self.assertEqual(blockgrid.stats()["spatial"], {'blocks': 3, 'objects': 4, 'dirty': 4})
+
+        # Changed blocks are parsed again
+        place((0, 0, 0), {"e": [495, 5, 5]})
+        transaction = blockgrid.grid[(0, 0, 0)]["data"][0]
+        transaction["data"] = json.dumps({"b": json.loads(transaction["data"])["b"]})
+        blockgrid.save_block((0, 0, 0), blockgrid.grid[(0, 0, 0)])
+        self.assertEqual(names(blockgrid.spatial.sphere((500, 10, 10), 15)), ["c", "e"])
+
+        blockgrid.replace_grid(blockgrid.grid)
+        self.assertEqual(names(blockgrid.spatial.box((-1e9, -1e9, -1e9), (1e9, 1e9, 1e9))), ["b", "c", "d", "e"])
+        self.assertRaises(ValueError, blockgrid.spatial.sphere, (0, 0, 0), float("inf"))
+
+        # Far apart corners cover more blocks than a range can count
+        self.assertEqual(names(blockgrid.spatial.box((-1e300, 0, 0), (1e300, 120, 120))), ["b", "c", "d", "e"])
+        self.assertEqual(names(blockgrid.spatial.sphere((0, 0, 0), 1e300)), ["b", "c", "d", "e"])
+
+    def test_region_blocks(self):
+        self.assertEqual(spatial.block_of((-510, 499, 1000)), (-1, 0, 2))
+        self.assertEqual(spatial.region_blocks((-510, 0, 0), (510, 10, 10), 3), [(-1, 0, 0), (0, 0, 0), (1, 0, 0)])
+        self.assertRaises(ValueError, spatial.region_blocks, (-510, 0, 0), (510, 10, 10), 2)
+        self.assertRaises(ValueError, spatial.region_blocks, (-1e300, 0, 0), (1e300, 10, 10), 125)
+        self.assertRaises(ValueError, spatial.parse_position, [0, 0, float("nan")])
+
+
+class EtagTest(unittest.TestCase):
+    def test_etag(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        grid_tag, block_tag, other_tag = blockgrid.etag(), blockgrid.etag((0, 0, 0)), blockgrid.etag((5, 5, 5))
+        self.assertEqual(blockgrid.etag(), grid_tag)
+
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        self.assertNotEqual(blockgrid.etag(), grid_tag)
+        self.assertNotEqual(blockgrid.etag((0, 0, 0)), block_tag)
+        self.assertEqual(blockgrid.etag((5, 5, 5)), other_tag)
+
+        # Refreshing a block that has not changed in storage keeps its tags
+        grid_tag, block_tag = blockgrid.etag(), blockgrid.etag((0, 0, 0))
+        blockgrid.refresh_index((0, 0, 0))
+        blockgrid.refresh_index((0, 0, 0))
+        self.assertEqual((blockgrid.etag(), blockgrid.etag((0, 0, 0))), (grid_tag, block_tag))
+        Blockgrid(blockgrid.storage).new_transaction((0, 0, 0), "a", "signature", 1, True)
+        blockgrid.refresh_index((0, 0, 0))
+        self.assertNotEqual(blockgrid.etag((0, 0, 0)), block_tag)
+
+        # Tags from before the grid was replaced never match again
+        block_tag = blockgrid.etag((0, 0, 0))
+        blockgrid.replace_grid(blockgrid.grid)
+        self.assertNotEqual(blockgrid.etag((0, 0, 0)), block_tag)
+
+
+class StreamingTest(unittest.TestCase):
+    def test_stream_grid(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((-1, 0, 0), "\u00e9\"</>", "signature", 1, True)
+        blockgrid.grid[(0, 0, -1)]["proof"] = Decimal("1.5")
+
+        app = Flask(__name__)
+
+        @app.route('/jsonify')
+        def rendered():
+            return jsonify({'grid': {":".join(map(str, k)): plain(v) for k, v in blockgrid.grid.items()},
+                            'length': len(blockgrid.grid)})
+
+        @app.route('/stream')
+        def streamed():
+            return stream_grid(app, {'grid': blockgrid.grid, 'length': len(blockgrid.grid)}, 'grid')
+
+        client = app.test_client()
+        expected = client.get('/jsonify').data
+        for chunk_chars in (1, streaming.CHUNK_CHARS):
+            streaming.CHUNK_CHARS = chunk_chars
+            response = client.get('/stream')
+            self.assertTrue(response.is_streamed)
+            self.assertEqual(response.data, expected)
+
+
+class WireTest(unittest.TestCase):
+    @unittest.skipIf(wire.msgpack is None, "msgpack is not installed")
+    def test_negotiation(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.sign_block((0, 0, 0), 0, "key")
+        blockgrid.new_transaction((-1, 0, 0), "data", "signature", 1, True)
+        grid = {":".join(map(str, k)): plain(v) for k, v in blockgrid.grid.items()}
+
+        app = Flask(__name__)
+
+        @app.route('/grid', methods=['GET', 'POST'])
+        def grid_route():
+            values = wire.read_request(request, ['grid'])
+            response = {'grid': values.get('grid', blockgrid.grid), 'length': len(blockgrid.grid)}
+            return wire.respond(app, request, response, 'grid')
+
+        client = app.test_client()
+        with app.test_request_context():
+            expected = jsonify({'grid': grid, 'length': len(grid)}).get_data()
+        self.assertEqual(client.get('/grid').data, expected)
+        self.assertEqual(client.get('/grid', headers={"Accept": "*/*"}).data, expected)
+
+        for encoding in wire.content_encodings():
+            headers = dict(wire.accept_headers(), **{"Accept-Encoding": encoding})
+            response = client.get('/grid', headers=headers)
+            self.assertEqual(response.mimetype, wire.MSGPACK)
+            self.assertEqual(response.headers["Content-Encoding"], encoding)
+            values = wire.unpack(wire.decompress(response.data, encoding), ['grid'])
+            self.assertEqual(json.dumps({":".join(map(str, k)): v for k, v in values['grid'].items()},
+                                        sort_keys=True), json.dumps(grid, sort_keys=True))
+
+            # Requests can be sent compressed and packed too
+            body = wire.compress(wire.pack({'grid': blockgrid.grid}, 'grid'), encoding)
+            response = client.post('/grid', data=body, headers={"Content-Type": wire.MSGPACK,
+                                                                "Content-Encoding": encoding})
+            self.assertEqual(json.loads(response.data)['grid'].keys(), grid.keys())
+
+    def test_decompression_limit(self):
+        body = json.dumps({"data": "x" * 1000}).encode()
+        for encoding in wire.content_encodings() + [None]:
+            compressed = wire.compress(body, encoding) if encoding is not None else body
+            self.assertEqual(wire.decompress(compressed, encoding, len(body)), body)
+            self.assertRaises(ValueError, wire.decompress, compressed, encoding, len(body) - 1)
+        self.assertEqual(wire.decompress(gzip.compress(b"a") + gzip.compress(b"b"), "gzip", 2), b"ab")
+
+        app = Flask(__name__)
+
+        @app.route('/grid', methods=['POST'])
+        def grid_route():
+            return jsonify(wire.read_request(request))
+
+        client = app.test_client()
+        limit = wire.MAX_REQUEST_BYTES
+        wire.MAX_REQUEST_BYTES = len(body) - 1
+        try:
+            for encoding in wire.content_encodings():
+                response = client.post('/grid', data=wire.compress(body, encoding),
+                                       headers={"Content-Type": wire.JSON, "Content-Encoding": encoding})
+                self.assertEqual(response.status_code, 413)
+        finally:
+            wire.MAX_REQUEST_BYTES = limit
+        response = client.post('/grid', data=wire.compress(body, "gzip"),
+                               headers={"Content-Type": wire.JSON, "Content-Encoding": "gzip"})
+        self.assertEqual(response.get_json(), {"data": "x" * 1000})
+
+    def test_peer_fetch(self):
+        # Through a real HTTP server and requests, which has to undo whatever compression it asked for
+        theirs = Blockgrid(SQLiteStorage(":memory:"))
+        theirs.sign_block((0, 0, 0), 0, "key")
+
+        app = Flask(__name__)
+
+        @app.route('/grid')
+        def grid_route():
+            return wire.respond(app, request, {'grid': theirs.grid, 'length': len(theirs.grid)}, 'grid')
+
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            ours = Blockgrid(SQLiteStorage(":memory:"))
+            length, grid = ours.fetch_grid(f"127.0.0.1:{server.server_port}")
+            self.assertEqual(length, len(theirs.grid))
+            self.assertEqual(as_blocks(grid), theirs.grid)
+        finally:
+            server.shutdown()
+
+
+class MinerTest(unittest.TestCase):
+    def test_parallel_proof(self):
+        miner = Miner(workers=2, batch=100, parallel_difficulty=1)
+        for index in [(0, 0, 0), (1, 0, 0), (0, -3, 2)]:
+            proof = miner.mine("last", index)
+            self.assertTrue(Blockgrid.valid_proof("last", proof, index))
+
+    def test_kernel_matches_valid_proof(self):
+        for last_proof in ["last", hashlib.sha256(b"{}").hexdigest()]:
+            for index in [(0, 0, 0), (1, 0, 0), (0, 2, 0), (0, 0, -3)]:
+                expected = next(p for p in range(10 ** 6) if Blockgrid.valid_proof(last_proof, p, index))
+                self.assertEqual(search(last_proof, max(map(abs, index)), 0, 1, 1000, lambda: False), expected)
+
+    def test_deadline_and_cancel(self):
+        self.assertIsNone(Miner(workers=2, parallel_difficulty=1).mine("last", (30, 0, 0), timeout=0.2))
+        cancel = threading.Event()
+        cancel.set()
+        self.assertIsNone(Miner().mine("last", (30, 0, 0), cancel=cancel))
+
+
+class MiningJobsTest(unittest.TestCase):
+    @staticmethod
+    def wait(job):
+        while job["status"] in ("queued", "running"):
+            time.sleep(0.01)
+        return job
+
+    def test_jobs(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        jobs = MiningJobs(blockgrid, refresh_interval=None)
+        job = jobs.submit((0, 0, 0), "key")
+        self.assertEqual(self.wait(job)["status"], "done")
+        self.assertEqual(blockgrid.grid[(0, 0, 0)]["owner"], "key")
+        self.assertIs(jobs.get(job["id"]), job)
+        self.assertIn((1, 0, 0), blockgrid.grid)
+
+    def test_claimed_elsewhere(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.new_block((0, 0, 30), "", (0, 0, 0))
+        jobs = MiningJobs(blockgrid, refresh_interval=None)
+        job = jobs.submit((0, 0, 30), "key")
+        self.assertIs(jobs.submit((0, 0, 30), "other"), job)
+        time.sleep(0.05)
+        blockgrid.sign_block((0, 0, 30), 0, "other")
+        self.assertEqual(self.wait(job)["status"], "cancelled")
+
+    def test_queue_limit(self):
+        blockgrid = Blockgrid(SQLiteStorage(":memory:"))
+        blockgrid.new_block((0, 0, 30), "", (0, 0, 0))
+        jobs = MiningJobs(blockgrid, max_pending=1, refresh_interval=None)
+        job = jobs.submit((0, 0, 30), "key")
+        with self.assertRaises(QueueFull):
+            jobs.submit((0, 30, 0), "key")
+        job["cancel"].set()
+        self.wait(job)
+
+
+class CapacityTest(unittest.TestCase):
+    @staticmethod
+    def throttled(failures):
+        calls = []
+
+        def request():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "PutItem")
+            return {"ConsumedCapacity": {"CapacityUnits": 1}}
+        return request
+
+    def test_retries_throttled_requests(self):
+        capacity = CapacityManager(5, 5, base_delay=0.001)
+        capacity.call("write", self.throttled(2))
+        stats = capacity.stats()
+        self.assertEqual(stats["write_throttles"], 2)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["writes"], 1)
+
+    def test_retry_budget(self):
+        capacity = CapacityManager(5, 5, max_retries=3, base_delay=0.001)
+        with self.assertRaises(ClientError):
+            capacity.call("read", self.throttled(10))
+        self.assertEqual(capacity.stats()["exhausted"], 1)
+        self.assertEqual(capacity.stats()["read_throttles"], 4)
+
+    def test_consumed_capacity_list(self):
+        capacity = CapacityManager(5, 5)
+        tokens = capacity.buckets["write"].tokens
+        response = {"ConsumedCapacity": [{"TableName": "Grid", "CapacityUnits": 3.0},
+                                         {"TableName": "Grid", "CapacityUnits": 2.0}]}
+        self.assertIs(capacity.call("write", lambda: response, 1), response)
+        self.assertAlmostEqual(capacity.buckets["write"].tokens, tokens - 5, places=1)
+        capacity.call("write", lambda: {"ConsumedCapacity": []})
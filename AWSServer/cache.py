@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import threading
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+
+class LazyGrid(MutableMapping):
+    def __init__(self, loader, indexes, capacity, pinned=None):
+        """
+        A grid that reads blocks from storage the first time they are used and only keeps the most recently
+        used ones in memory. Evicted blocks stay in the grid and are read again when they are next used
+        :param loader: <function> Reads the block at an index from storage, returning None if it does not exist
+        :param indexes: <iterable> The indexes of every block in storage
+        :param capacity: <int> How many blocks are kept in memory
+        :param pinned: <function> Returns True for indexes that must not be evicted, eg. unsaved blocks
+        """
+        self.loader = loader
+        self.indexes = set(indexes)
+        self.capacity = capacity
+        self.pinned = pinned if pinned is not None else (lambda idx: False)
+        self.blocks = OrderedDict()
+        self.lock = threading.RLock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __getitem__(self, idx):
+        with self.lock:
+            if idx in self.blocks:
+                self.counters["hits"] += 1
+                self.blocks.move_to_end(idx)
+                return self.blocks[idx]
+            if idx not in self.indexes:
+                raise KeyError(idx)
+            self.counters["misses"] += 1
+
+        block = self.loader(idx)
+        with self.lock:
+            if block is None:
+                self.indexes.discard(idx)
+                raise KeyError(idx)
+            # Another thread may have loaded it in the meantime
+            if idx in self.blocks:
+                return self.blocks[idx]
+            self.blocks[idx] = block
+            self.evict()
+        return block
+
+    def __setitem__(self, idx, block):
+        with self.lock:
+            self.indexes.add(idx)
+            self.blocks[idx] = block
+            self.blocks.move_to_end(idx)
+            self.evict()
+
+    def __delitem__(self, idx):
+        with self.lock:
+            self.indexes.remove(idx)
+            self.blocks.pop(idx, None)
+
+    def __contains__(self, idx):
+        return idx in self.indexes
+
+    def __iter__(self):
+        return iter(list(self.indexes))
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def cached(self, idx):
+        """
+        :return: <bool> True if the block at idx is currently held in memory
+        """
+        return idx in self.blocks
+
+    def invalidate(self, idx):
+        """
+        Drop the block at idx from memory so it is read from storage when it is next used
+        :param idx: <tuple> The index of the block
+        """
+        with self.lock:
+            self.indexes.add(idx)
+            self.blocks.pop(idx, None)
+
+    def evict(self):
+        for idx in list(self.blocks):
+            if len(self.blocks) <= self.capacity:
+                break
+            if not self.pinned(idx):
+                del self.blocks[idx]
+                self.counters["evictions"] += 1
+
+    def stats(self):
+        """
+        :return: <dict> Cache hit, miss and eviction counters and the number of blocks held in memory
+        """
+        with self.lock:
+            return dict(self.counters, cached=len(self.blocks), blocks=len(self.indexes))
+
+
+class HashCache(object):
+    def __init__(self, capacity):
+        """
+        Remembers the hashes of blocks by their index and version. The hashed fields are kept with each hash and
+        compared on lookup, so a block that was changed without bumping its version, or a block from another
+        node's grid with the same index and version as ours, is hashed again rather than given a stale hash
+        :param capacity: <int> How many hashes are kept
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        # The keys of the entries of each index, so a block's hashes can be dropped when it is saved
+        self.keys = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, kind, block, fields):
+        """
+        :param kind: <str> Which hash of the block this is, eg. "hash" or "hash_without_proof"
+        :param block: <dict> The block being hashed
+        :param fields: <dict> The fields of the block that are hashed
+        :return: <str> The SHA-256 hash of fields
+        """
+        idx = tuple(block.get("index") or ())
+        key = (kind, idx, block.get("version"))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == fields:
+                self.counters["hits"] += 1
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.counters["misses"] += 1
+
+        # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
+        digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            self.entries[key] = (fields, digest)
+            self.entries.move_to_end(key)
+            self.keys.setdefault(idx, set()).add(key)
+            while len(self.entries) > self.capacity:
+                old, _ = self.entries.popitem(last=False)
+                self.drop_key(old)
+                self.counters["evictions"] += 1
+        return digest
+
+    def drop_key(self, key):
+        keys = self.keys.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.keys[key[1]]
+
+    def invalidate(self, idx=None):
+        """
+        Forget the hashes of the block at idx
+        :param idx: <tuple> The index of the block, None to forget every hash
+        """
+        with self.lock:
+            if idx is None:
+                self.counters["invalidations"] += len(self.entries)
+                self.entries.clear()
+                self.keys.clear()
+                return
+            for key in self.keys.pop(tuple(idx), ()):
+                del self.entries[key]
+                self.counters["invalidations"] += 1
+
+    def stats(self):
+        """
+        :return: <dict> Hit, miss, eviction and invalidation counters, the hit rate and the number of hashes kept
+        """
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return dict(self.counters, hit_rate=self.counters["hits"] / lookups if lookups else 0.0,
+                        cached=len(self.entries))
+
+
+class ValidationLedger(object):
+    def __init__(self, capacity):
+        """
+        Remembers which blocks have already had their proof and signatures verified. A block is identified by
+        (index, version, header hash, data digest), so any change to it makes it a new block that is checked again
+        :param capacity: <int> How many verified blocks are remembered
+        """
+        self.capacity = capacity
+        self.verified = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"skipped": 0, "checked": 0, "evictions": 0}
+
+    def __contains__(self, identity):
+        with self.lock:
+            if identity in self.verified:
+                self.counters["skipped"] += 1
+                self.verified.move_to_end(identity)
+                return True
+            self.counters["checked"] += 1
+            return False
+
+    def add(self, identity):
+        with self.lock:
+            self.verified[identity] = True
+            self.verified.move_to_end(identity)
+            while len(self.verified) > self.capacity:
+                self.verified.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def discard(self, identity):
+        with self.lock:
+            self.verified.pop(identity, None)
+
+    def clear(self):
+        with self.lock:
+            self.verified.clear()
+
+    def stats(self):
+        """
+        :return: <dict> How many blocks were skipped and checked, and the number of verified blocks remembered
+        """
+        with self.lock:
+            return dict(self.counters, verified=len(self.verified))
+
+
+class SignatureCache(object):
+    # Cache files are SIGNATURE_MAGIC followed by the 32 byte digests, least recently used first
+    SIGNATURE_MAGIC = b"KGSIG1"
+
+    def __init__(self, capacity, path=None):
+        """
+        Remembers the digests of signatures that have been verified. Only signatures that passed are added, a
+        signature that is not in the cache still has to be verified
+        :param capacity: <int> How many signatures are remembered
+        :param path: <str> A file the cache is read from if it exists and written to by save(), None to only keep
+                     it in memory
+        """
+        self.capacity = capacity
+        self.path = path
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                contents = f.read()
+            if contents.startswith(self.SIGNATURE_MAGIC):
+                for i in range(len(self.SIGNATURE_MAGIC), len(contents) - 31, 32):
+                    self.digests[contents[i:i + 32]] = True
+                self.evict()
+
+    def __contains__(self, digest):
+        with self.lock:
+            if digest in self.digests:
+                self.counters["hits"] += 1
+                self.digests.move_to_end(digest)
+                return True
+            self.counters["misses"] += 1
+            return False
+
+    def add(self, digest):
+        with self.lock:
+            self.digests[digest] = True
+            self.digests.move_to_end(digest)
+            self.evict()
+
+    def evict(self):
+        while len(self.digests) > self.capacity:
+            self.digests.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def save(self):
+        """
+        Write the cache to its file, if it has one
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            contents = self.SIGNATURE_MAGIC + b"".join(self.digests)
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(contents)
+        os.replace(self.path + ".tmp", self.path)
+
+    def stats(self):
+        """
+        :return: <dict> Hit, miss and eviction counters and the number of signatures remembered
+        """
+        with self.lock:
+            return dict(self.counters, cached=len(self.digests))
@@ -0,0 +1,161 @@
+import math
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+from time import monotonic, sleep
+
+# Error codes DynamoDB uses when a request is rejected for exceeding capacity
+THROTTLE_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        """
+        :param rate: <float> Tokens added per second
+        :param burst: <float> Maximum number of tokens the bucket can hold
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, tokens):
+        """
+        Wait until the bucket can pay for a request. Requests larger than the bucket are let through once
+        it is full and leave it in debt, which later requests wait out
+        :param tokens: <float> The cost of the request
+        :return: <float> The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                needed = min(tokens, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                delay = (needed - self.tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+    def debit(self, tokens):
+        """
+        Charge (or refund, if negative) the bucket without waiting
+        :param tokens: <float> The number of tokens to remove
+        """
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.burst, self.tokens - tokens)
+
+
+class CapacityManager(object):
+    def __init__(self, read_units=None, write_units=None, burst_seconds=300, max_retries=8, base_delay=0.05,
+                 max_delay=5.0):
+        """
+        Client side rate limiting for a DynamoDB table
+        :param read_units: <int> Provisioned read capacity of the table, None if it is not limited
+        :param write_units: <int> Provisioned write capacity of the table, None if it is not limited
+        :param burst_seconds: <int> How many seconds of unused capacity can be saved up (DynamoDB keeps 300)
+        :param max_retries: <int> How many times a throttled request is retried before giving up
+        :param base_delay: <float> The first backoff delay in seconds
+        :param max_delay: <float> The longest backoff delay in seconds
+        """
+        self.buckets = {
+            "read": TokenBucket(read_units, read_units * burst_seconds) if read_units else None,
+            "write": TokenBucket(write_units, write_units * burst_seconds) if write_units else None,
+        }
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.counters = {
+            "reads": 0,
+            "writes": 0,
+            "read_throttles": 0,
+            "write_throttles": 0,
+            "retries": 0,
+            "exhausted": 0,
+            "wait_seconds": 0.0,
+        }
+
+    @classmethod
+    def from_table(cls, table, **kwargs):
+        """
+        Size the buckets to a table's provisioned throughput (on-demand tables are not limited)
+        :param table: <Table> A boto3 DynamoDB table resource
+        :return: <CapacityManager>
+        """
+        throughput = table.provisioned_throughput or {}
+        return cls(throughput.get("ReadCapacityUnits") or None, throughput.get("WriteCapacityUnits") or None,
+                   **kwargs)
+
+    @staticmethod
+    def write_units(item):
+        """
+        Estimate the write capacity units a put of the given item costs (1 unit per KB)
+        :param item: <dict> The item being written
+        :return: <int>
+        """
+        size = 0
+        for k, v in item.items():
+            size += len(k) + (len(v) if isinstance(v, (str, bytes)) else 21)
+        return max(1, math.ceil(size / 1024))
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def stats(self):
+        """
+        :return: <dict> A copy of the request and throttle counters
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def call(self, kind, request, units=1):
+        """
+        Make a request against the table, waiting for capacity first and retrying with exponential
+        backoff and jitter if it is throttled anyway
+        :param kind: <str> "read" or "write"
+        :param request: <function> Makes the request and returns its response
+        :param units: <int> The estimated capacity the request consumes
+        :return: The response of the request
+        """
+        bucket = self.buckets[kind]
+        attempt = 0
+        while True:
+            if bucket is not None:
+                self.count("wait_seconds", bucket.acquire(units))
+            try:
+                response = request()
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in THROTTLE_CODES:
+                    raise
+                self.count(kind + "_throttles")
+                if attempt >= self.max_retries:
+                    self.count("exhausted")
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                self.count("retries")
+                self.count("wait_seconds", delay)
+                sleep(delay)
+                continue
+
+            self.count(kind + "s")
+            # Correct our estimate with what DynamoDB says the request actually cost
+            consumed = response.get("ConsumedCapacity") if isinstance(response, dict) else None
+            # Requests spanning several tables, eg. batch and transactional writes, report a list, one per table
+            if isinstance(consumed, list):
+                consumed = {"CapacityUnits": sum(c.get("CapacityUnits", 0) for c in consumed)} if consumed else None
+            if bucket is not None and consumed:
+                bucket.debit(consumed["CapacityUnits"] - units)
+            return response
@@ -0,0 +1,127 @@
+import hashlib
+import threading
+
+# Levels of the tree below the root. A node at level l covers the 2^l x 2^l x 2^l cube of block indexes with the
+# same index >> l, level 0 nodes are the blocks themselves
+DEPTH = 16
+
+
+def parent(node):
+    """
+    :param node: <tuple> (level, i, j, k) of a node
+    :return: <tuple> The node one level up that covers it
+    """
+    level, i, j, k = node
+    return level + 1, i >> 1, j >> 1, k >> 1
+
+
+def combine(children):
+    """
+    :param children: <dict> The digest of each child of a node
+    :return: <str> The digest of the node
+    """
+    h = hashlib.sha256()
+    for child in sorted(children):
+        h.update(f"{child}:{children[child]};".encode())
+    return h.hexdigest()
+
+
+class MerkleGrid(object):
+    def __init__(self, digest):
+        """
+        A spatial Merkle tree over the blocks of a grid. Two grids with the same root hold the same blocks, and
+        where they differ only the subtrees whose digests differ have to be compared. Changed blocks are marked
+        with update() and their branches are recomputed the next time the tree is read
+        :param digest: <function> Returns the digest of the block at an index, or None if there is no block there
+        """
+        self.digest = digest
+        self.nodes = {}
+        # The digests of the children of each node, by child
+        self.children = {}
+        # The nodes at the top level, which make up the root
+        self.top = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def update(self, idx):
+        """
+        Mark the block at idx as changed
+        :param idx: <tuple> The index of the block
+        """
+        with self.lock:
+            self.dirty.add(tuple(idx))
+
+    def reset(self, indexes):
+        """
+        Rebuild the whole tree the next time it is read, eg. after the grid was replaced
+        :param indexes: <iterable> The index of every block in the grid
+        """
+        with self.lock:
+            self.nodes.clear()
+            self.children.clear()
+            self.top.clear()
+            self.dirty = set(map(tuple, indexes))
+
+    def refresh(self):
+        """
+        Recompute the digests of the changed blocks and of the nodes above them, one level at a time
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            changed = {}
+            for idx in self.dirty:
+                changed[(0,) + idx] = self.digest(idx)
+            self.dirty = set()
+
+            for level in range(DEPTH + 1):
+                above = {}
+                for node, digest in changed.items():
+                    if digest is None:
+                        self.nodes.pop(node, None)
+                    else:
+                        self.nodes[node] = digest
+                    if level == DEPTH:
+                        if digest is None:
+                            self.top.pop(node, None)
+                        else:
+                            self.top[node] = digest
+                        continue
+                    up = parent(node)
+                    siblings = self.children.setdefault(up, {})
+                    if digest is None:
+                        siblings.pop(node, None)
+                    else:
+                        siblings[node] = digest
+                    above[up] = None
+                for up in above:
+                    if self.children[up]:
+                        above[up] = combine(self.children[up])
+                    else:
+                        del self.children[up]
+                changed = above
+
+    def root(self):
+        """
+        :return: <dict> The root digest and the digests of the top level nodes it is made of
+        """
+        self.refresh()
+        with self.lock:
+            top = dict(self.top)
+        return {'digest': combine(top), 'depth': DEPTH, 'children': self.describe(top)}
+
+    def node(self, node):
+        """
+        :param node: <tuple> (level, i, j, k) of a node
+        :return: <dict> The digest of the node and the digests of its children, or None if the node is empty
+        """
+        self.refresh()
+        with self.lock:
+            if node not in self.nodes:
+                return None
+            return {'node': list(node), 'digest': self.nodes[node],
+                    'children': self.describe(self.children.get(node, {}))}
+
+    @staticmethod
+    def describe(children):
+        return [{'node': list(child), 'digest': digest} for child, digest in sorted(children.items())]
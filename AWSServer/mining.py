@@ -0,0 +1,138 @@
+import hashlib
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+# Set in each worker process, tells it to stop searching
+stop_event = None
+
+
+def init_worker(event):
+    global stop_event
+    stop_event = event
+
+
+def first_valid(prefix, difficulty, proofs):
+    """
+    The mining kernel: hash(last_proof, p) for each p in proofs, returning the first p whose hash has
+    difficulty leading zeroes in hex
+    :param prefix: <sha256> A hash that has been fed last_proof, it is copied rather than recomputed for each proof
+    :param difficulty: <int> How many leading zero hex digits a valid hash has
+    :param proofs: <iterable> The proofs to try, in order
+    :return: <int> The first valid proof, or None
+    """
+    # Each zero byte of the digest is two zero hex digits, an odd difficulty also needs the high nibble of the
+    # next byte to be zero
+    zero_bytes, odd = divmod(difficulty, 2)
+    zeroes = bytes(zero_bytes)
+    copy = prefix.copy
+    for proof in proofs:
+        h = copy()
+        h.update(str(proof).encode())
+        digest = h.digest()
+        if digest[:zero_bytes] == zeroes and (not odd or digest[zero_bytes] < 16):
+            return proof
+    return None
+
+
+def search(last_proof, difficulty, offset, stride, batch, should_stop=None):
+    """
+    Try the proofs offset, offset + stride, offset + 2 * stride, ... until one is valid
+    :param last_proof: <str> The hash the proof is for
+    :param difficulty: <int> How many leading zeroes the hash of a valid proof has
+    :param offset: <int> The first proof to try
+    :param stride: <int> The distance between proofs that are tried
+    :param batch: <int> How many proofs are tried between calls to should_stop
+    :param should_stop: <function> Stops the search when it returns True, defaults to checking the event the
+                        worker process was started with
+    :return: <int> A valid proof, or None if the search was stopped
+    """
+    should_stop = should_stop if should_stop is not None else stop_event.is_set
+    # valid_proof hashes f'{last_proof}{proof}', the last_proof part is the same for every proof
+    prefix = hashlib.sha256(f'{last_proof}'.encode())
+    proof = offset
+    while not should_stop():
+        result = first_valid(prefix, difficulty, range(proof, proof + stride * batch, stride))
+        if result is not None:
+            return result
+        proof += stride * batch
+    return None
+
+
+class Miner(object):
+    def __init__(self, workers=None, batch=10000, parallel_difficulty=5):
+        """
+        Searches for proofs of work on several processes
+        :param workers: <int> Number of processes to search with, defaults to the number of CPUs
+        :param batch: <int> How many proofs a worker tries between checks for whether it should stop
+        :param parallel_difficulty: <int> Easier proofs are searched for in the calling process
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.batch = batch
+        self.parallel_difficulty = parallel_difficulty
+
+    def mine(self, last_proof, index, timeout=None, cancel=None):
+        """
+        Find a proof p such that hash(last_proof, p) has max(abs(index)) leading zeroes
+        :param last_proof: <str> The hash the proof is for
+        :param index: <tuple> The index of the block being mined
+        :param timeout: <float> Give up after this many seconds
+        :param cancel: <Event> Give up when this is set
+        :return: <int> The proof, or None if the search timed out or was cancelled
+        """
+        difficulty = max(map(abs, index))
+        # A sha256 hex digest only has 64 characters
+        if difficulty > 64:
+            return None
+
+        deadline = time() + timeout if timeout is not None else None
+
+        def expired():
+            return (deadline is not None and time() > deadline) or (cancel is not None and cancel.is_set())
+
+        if difficulty < self.parallel_difficulty or self.workers == 1:
+            return search(last_proof, difficulty, 0, 1, self.batch, expired)
+
+        ctx = multiprocessing.get_context()
+        stop = ctx.Event()
+        with ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=init_worker, initargs=(stop,)) as pool:
+            pending = {pool.submit(search, last_proof, difficulty, w, self.workers, self.batch)
+                       for w in range(self.workers)}
+            try:
+                while pending:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        if future.result() is not None:
+                            return future.result()
+                    if expired():
+                        return None
+            finally:
+                # Every other worker stops at the end of its current batch
+                stop.set()
+        return None
+
+
+if __name__ == "__main__":
+    # Compare the kernel with the loop proof_of_work used to run, in hashes per second (best of 5)
+    n = 200000
+    index = (8, 0, 0)
+    last = hashlib.sha256(b"{}").hexdigest()
+
+    def legacy_loop():
+        for p in range(n):
+            guess_hash = hashlib.sha256(f'{last}{p}'.encode()).hexdigest()
+            diff = max(map(abs, index))
+            guess_hash[:diff] == "0" * diff
+
+    def kernel():
+        first_valid(hashlib.sha256(last.encode()), max(map(abs, index)), range(n))
+
+    for name, run in [("valid_proof loop", legacy_loop), ("mining kernel", kernel)]:
+        best = None
+        for _ in range(5):
+            start = time()
+            run()
+            best = min(best or float("inf"), time() - start)
+        print(f"{name}: {n / best:,.0f} hashes/s")
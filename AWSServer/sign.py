@@ -3,6 +3,8 @@ from Crypto import Random
 from Crypto.Hash import SHA256
 from Crypto.Signature import pkcs1_15
 import base64
+import os
+import threading
 
 
 def rsakeys():
@@ -44,6 +46,52 @@ def load_saved_keys():
     return private_key, public_key
 
 
+class Signer(object):
+    def __init__(self, private_path="./private.pem", public_path="./public.pem"):
+        """
+        Signs with the saved keys, which are parsed once and read again only when the key files change
+        :param private_path: <str> Path of the private key
+        :param public_path: <str> Path of the public key
+        """
+        self.paths = (private_path, public_path)
+        self.stamps = None
+        self.private_key = None
+        self.public_key = None
+        self.signer = None
+        self.lock = threading.Lock()
+
+    def keys(self):
+        """
+        Reload the keys if their files have changed since they were last read
+        :return: <tuple> The private and public keys
+        """
+        stamps = [(st.st_mtime_ns, st.st_size) for st in map(os.stat, self.paths)]
+        with self.lock:
+            if stamps != self.stamps:
+                with open(self.paths[0], "rb") as prv_file:
+                    self.private_key = RSA.importKey(prv_file.read())
+                with open(self.paths[1], "rb") as pub_file:
+                    self.public_key = RSA.importKey(pub_file.read())
+                self.signer = pkcs1_15.new(self.private_key)
+                self.stamps = stamps
+            return self.private_key, self.public_key
+
+    def sign_many(self, payloads):
+        """
+        :param payloads: <list> The data to sign
+        :return: <list> The signature of each payload
+        """
+        if len(payloads) == 0:
+            return []
+        self.keys()
+        with self.lock:
+            signer = self.signer
+        return [signer.sign(SHA256.new(data)) for data in payloads]
+
+    def sign(self, data):
+        return self.sign_many([data])[0]
+
+
 if __name__ == "__main__":
     d = b"hello there"
     generate_keys()
@@ -0,0 +1,214 @@
+import functools
+import itertools
+import json
+import math
+import operator
+import threading
+
+# Blocks are BLOCK_SIZE world units wide, an object at position p belongs to the block int(p / BLOCK_SIZE)
+BLOCK_SIZE = 500
+
+
+def block_range(low, high):
+    """
+    :param low: <float> The lowest world coordinate on an axis
+    :param high: <float> The highest world coordinate on the axis
+    :return: <range> The block indexes on the axis that hold positions between low and high
+    """
+    return range(int(low / BLOCK_SIZE), int(high / BLOCK_SIZE) + 1)
+
+
+def block_span(low, high):
+    """
+    :param low: <float> The lowest world coordinate on an axis
+    :param high: <float> The highest world coordinate on the axis
+    :return: <int> The number of blocks on the axis that hold positions between low and high. Unlike the length of
+             block_range(), it does not overflow for far apart coordinates
+    """
+    return max(0, int(high / BLOCK_SIZE) - int(low / BLOCK_SIZE) + 1)
+
+
+def volume(low, high):
+    """
+    :param low: <tuple> The lowest corner of a box in world space
+    :param high: <tuple> The highest corner of the box
+    :return: <int> The number of blocks the box covers
+    """
+    return functools.reduce(operator.mul, (block_span(lo, hi) for lo, hi in zip(low, high)), 1)
+
+
+def block_of(position):
+    """
+    :param position: <tuple> A world position
+    :return: <tuple> The index of the block holding it
+    """
+    return tuple(int(x / BLOCK_SIZE) for x in position)
+
+
+def region_blocks(low, high, limit):
+    """
+    :param low: <tuple> The lowest corner of a box in world space
+    :param high: <tuple> The highest corner of the box
+    :param limit: <int> The most blocks the box may cover
+    :return: <list> The indexes of the blocks the box covers
+    :raises ValueError: If it covers more than limit blocks
+    """
+    if any(block_span(lo, hi) > limit for lo, hi in zip(low, high)) or volume(low, high) > limit:
+        raise ValueError(f"A region can cover at most {limit} blocks")
+    return list(itertools.product(*(block_range(lo, hi) for lo, hi in zip(low, high))))
+
+
+def parse_position(values):
+    """
+    :param values: <list> A world position sent by a client
+    :return: <tuple> The position
+    :raises ValueError: If it is not three finite numbers
+    """
+    try:
+        position = tuple(float(x) for x in values)
+    except TypeError:
+        raise ValueError("A position is a list of three numbers")
+    if len(position) != 3 or not all(map(math.isfinite, position)):
+        raise ValueError("A position is a list of three numbers")
+    return position
+
+
+def block_objects(block):
+    """
+    Parse the objects placed in a block. Each transaction's data maps object names to objects, those with a
+    world position are returned
+    :param block: <dict> The block
+    :return: <list> (position, name, object, approved) of each object, in the order they were added
+    """
+    found = []
+    for d in block["data"]:
+        try:
+            values = json.loads(d["data"])
+        except (TypeError, ValueError):
+            continue
+        if not isinstance(values, dict):
+            continue
+        for name, obj in values.items():
+            try:
+                position = tuple(float(x) for x in obj["position"])
+            except (TypeError, ValueError, KeyError):
+                continue
+            if len(position) == 3:
+                found.append((position, name, obj, d["approved"]))
+    return found
+
+
+class SpatialIndex(object):
+    def __init__(self, blocks, cell=50):
+        """
+        The positions of the objects in each block, bucketed into a uniform grid of cells so a query only looks
+        at the objects in the cells it overlaps. Changed blocks are marked with update() and parsed again the
+        next time a query reaches them
+        :param blocks: <function> Returns the block at an index, or None if there is no block there
+        :param cell: <float> The width of a cell in world units
+        """
+        self.blocks = blocks
+        self.cell = cell
+        # The objects in each cell of each block, by block and cell
+        self.cells = {}
+        self.counts = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def update(self, idx):
+        """
+        Mark the block at idx as changed
+        :param idx: <tuple> The index of the block
+        """
+        with self.lock:
+            self.dirty.add(tuple(idx))
+
+    def reset(self, indexes):
+        """
+        Parse every block again when a query reaches it, eg. after the grid was replaced
+        :param indexes: <iterable> The index of every block in the grid
+        """
+        with self.lock:
+            self.cells.clear()
+            self.counts.clear()
+            self.dirty = set(map(tuple, indexes))
+
+    def cell_of(self, position):
+        return tuple(math.floor(x / self.cell) for x in position)
+
+    def refresh(self, indexes):
+        """
+        Parse the changed blocks among indexes
+        :param indexes: <list> The indexes of the blocks a query reaches
+        """
+        with self.lock:
+            changed = [idx for idx in indexes if idx in self.dirty]
+            self.dirty.difference_update(changed)
+
+        for idx in changed:
+            try:
+                block = self.blocks(idx)
+            except KeyError:
+                block = None
+            cells = {}
+            for entry in block_objects(block) if block is not None else []:
+                cells.setdefault(self.cell_of(entry[0]), []).append(entry)
+            with self.lock:
+                if cells:
+                    self.cells[idx] = cells
+                    self.counts[idx] = sum(map(len, cells.values()))
+                else:
+                    self.cells.pop(idx, None)
+                    self.counts.pop(idx, None)
+
+    def query(self, low, high, inside):
+        """
+        :param low: <tuple> The lowest corner of the box the query covers
+        :param high: <tuple> The highest corner of the box
+        :param inside: <function> Returns True for the positions in the box that are part of the result
+        :return: <list> (index, position, name, object, approved) of each object found, by block
+        """
+        ranges = [block_range(lo, hi) for lo, hi in zip(low, high)]
+        with self.lock:
+            known = set(self.cells) | self.dirty
+        # Large queries only look at the blocks that have anything in them
+        if volume(low, high) <= len(known):
+            indexes = [idx for idx in itertools.product(*ranges) if idx in known]
+        else:
+            indexes = sorted(idx for idx in known if all(i in r for i, r in zip(idx, ranges)))
+        self.refresh(indexes)
+
+        first, last = self.cell_of(low), self.cell_of(high)
+        found = []
+        with self.lock:
+            for idx in indexes:
+                for cell, entries in self.cells.get(idx, {}).items():
+                    if all(a <= c <= b for a, c, b in zip(first, cell, last)):
+                        found += [(idx,) + entry for entry in entries if inside(entry[0])]
+        return found
+
+    def sphere(self, center, radius):
+        """
+        :param center: <tuple> The world position of the center of the sphere
+        :param radius: <float> The radius of the sphere
+        :return: <list> (index, position, name, object, approved) of each object in the sphere
+        """
+        if not 0 <= radius < math.inf:
+            raise ValueError("A radius is a finite number that is not negative")
+        return self.query(tuple(c - radius for c in center), tuple(c + radius for c in center),
+                          lambda p: sum((x - c) * (x - c) for x, c in zip(p, center)) <= radius * radius)
+
+    def box(self, low, high):
+        """
+        :param low: <tuple> The lowest corner of the box
+        :param high: <tuple> The highest corner of the box
+        :return: <list> (index, position, name, object, approved) of each object in the box
+        """
+        return self.query(low, high, lambda p: all(lo <= x <= hi for lo, x, hi in zip(low, p, high)))
+
+    def stats(self):
+        """
+        :return: <dict> The number of indexed blocks and objects, and of blocks waiting to be parsed again
+        """
+        with self.lock:
+            return {'blocks': len(self.cells), 'objects': sum(self.counts.values()), 'dirty': len(self.dirty)}
@@ -0,0 +1,378 @@
+import sqlite3
+import threading
+
+import boto3
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import Binary
+from concurrent.futures import ThreadPoolExecutor
+
+from capacity import CapacityManager
+
+
+class Storage(object):
+    """
+    Where the grid is persisted. Every item is a dict with three fields:
+     - index: <str> The key of the item, eg. "(0, 0, 1)_0"
+     - version: <int> The version of the item, used for conditional writes
+     - block: <str|bytes> The payload of the item
+    """
+
+    def get(self, key):
+        """
+        Read a single item
+        :param key: <str> The key of the item
+        :return: <dict> The item, or None if it does not exist
+        """
+        raise NotImplementedError
+
+    def put(self, item, previous_version=None):
+        """
+        Write an item if it does not exist yet or if its stored version is still previous_version
+        :param item: <dict> The item being written
+        :param previous_version: <int> The version the item is expected to have in storage, None to always write
+        :return: <bool> True if the item was written, False if the condition failed
+        """
+        raise NotImplementedError
+
+    def insert(self, item):
+        """
+        Write an item only if no item with the same key exists yet
+        :param item: <dict> The item being written
+        :return: <bool> True if the item was written, False if the key is taken
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """
+        Remove an item if it exists
+        :param key: <str> The key of the item
+        """
+        raise NotImplementedError
+
+    def write_many(self, items, condition=None):
+        """
+        Write several items together, as one transaction where the backend supports it
+        :param items: <list> The items being written
+        :param condition: <tuple> (key, previous_version) of an item whose version must still match, or None
+        :return: <bool> True if the items were written, False if the condition failed
+        """
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """
+        Remove several items
+        :param keys: <list> The keys of the items
+        """
+        raise NotImplementedError
+
+    def scan(self):
+        """
+        Read every item in storage
+        :return: <list> The items
+        """
+        raise NotImplementedError
+
+    def versions(self):
+        """
+        Read the key and version of every item in storage, without their payloads
+        :return: <list> (key, version) of each item
+        """
+        raise NotImplementedError
+
+    def stats(self):
+        """
+        :return: <dict> Counters describing the requests made to storage
+        """
+        return {}
+
+
+# A sparse global secondary index of the items that carry LISTED, with their version projected. Scanning it reads
+# a few bytes per block instead of every snapshot chunk
+VERSIONS_INDEX = "versions"
+LISTED = "listed"
+
+
+def listed(key):
+    """
+    :param key: <str> The key of an item
+    :return: <bool> True if the item belongs in the versions index: headers, which hold a block's version, and log
+             entries, which tell where its log ends. Snapshot chunks are left out
+    """
+    return key.endswith("_header") or "_log_" in key
+
+
+class DynamoDBStorage(Storage):
+    def __init__(self, table_name='Grid', segments=8, dynamodb=None):
+        """
+        :param table_name: <str> The table the grid is kept in
+        :param segments: <int> How many segments the table is scanned in, in parallel
+        :param dynamodb: <ServiceResource> The DynamoDB resource to use, defaults to one signed with the keys in the
+                         accesskey and secretkey files
+        """
+        if dynamodb is None:
+            with open("accesskey", "r") as ak, open("./secretkey", "r") as sk:
+                dynamodb = boto3.resource('dynamodb', endpoint_url="https://dynamodb.us-east-2.amazonaws.com",
+                                          region_name='us-east-2',
+                                          aws_access_key_id=ak.read(),
+                                          aws_secret_access_key=sk.read())
+        self.dynamodb = dynamodb
+        self.table = self.dynamodb.Table(table_name)
+        self.dynamodb_client = boto3.client('dynamodb', region_name='us-east-2')
+        self.segments = segments
+        self.capacity = CapacityManager.from_table(self.table)
+        # Until the versions index is active, versions() scans the whole table
+        self.indexed = any(index['IndexName'] == VERSIONS_INDEX and index.get('IndexStatus') == 'ACTIVE'
+                           for index in self.table.global_secondary_indexes or [])
+
+    @staticmethod
+    def to_dynamodb(item):
+        return dict(item, **{LISTED: item["index"]}) if listed(item["index"]) else item
+
+    @staticmethod
+    def from_dynamodb(item):
+        item.pop(LISTED, None)
+        if isinstance(item.get("block"), Binary):
+            item["block"] = item["block"].value
+        return item
+
+    def get(self, key):
+        result = self.capacity.call("read", lambda: self.table.query(KeyConditionExpression=Key('index').eq(key),
+                                                                     ReturnConsumedCapacity='TOTAL'))
+        if len(result['Items']) == 0:
+            return None
+        return self.from_dynamodb(result['Items'][0])
+
+    def put(self, item, previous_version=None):
+        if previous_version is None:
+            return self.write(item)
+        return self.write(item, Attr('version').eq(previous_version) | Attr('version').not_exists())
+
+    def insert(self, item):
+        return self.write(item, Attr('index').not_exists())
+
+    def write(self, item, condition=None):
+        item = self.to_dynamodb(item)
+        kwargs = {'Item': item, 'ReturnConsumedCapacity': 'TOTAL'}
+        if condition is not None:
+            kwargs['ConditionExpression'] = condition
+        try:
+            self.capacity.call("write", lambda: self.table.put_item(**kwargs), self.capacity.write_units(item))
+        except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def delete(self, key):
+        self.capacity.call("write", lambda: self.table.delete_item(Key={'index': key},
+                                                                   ReturnConsumedCapacity='TOTAL'))
+
+    def write_many(self, items, condition=None):
+        units = sum(self.capacity.write_units(item) for item in items)
+        # Transactions are limited to 100 items and 4MB
+        if len(items) > 100 or units > 4000:
+            conditional = [item for item in items if condition is not None and item["index"] == condition[0]]
+            for item in conditional:
+                if not self.put(item, condition[1]):
+                    return False
+            for item in items:
+                if item not in conditional:
+                    self.put(item)
+            return True
+
+        # The resource's client serializes the values itself
+        transaction = []
+        for item in items:
+            put = {'TableName': self.table.name, 'Item': self.to_dynamodb(item)}
+            if condition is not None and item["index"] == condition[0]:
+                put['ConditionExpression'] = "attribute_not_exists(#v) OR #v = :v"
+                put['ExpressionAttributeNames'] = {'#v': 'version'}
+                put['ExpressionAttributeValues'] = {':v': condition[1]}
+            transaction.append({'Put': put})
+
+        client = self.dynamodb.meta.client
+        try:
+            # Transactional writes cost twice as much capacity
+            self.capacity.call("write", lambda: client.transact_write_items(TransactItems=transaction,
+                                                                            ReturnConsumedCapacity='TOTAL'),
+                               2 * units)
+        except client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if any(reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons):
+                return False
+            raise
+        return True
+
+    def delete_many(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 25):
+            request_items = {self.table.name: [{'DeleteRequest': {'Key': {'index': key}}} for key in keys[i:i + 25]]}
+            while request_items:
+                response = self.capacity.call("write", lambda: self.dynamodb.batch_write_item(
+                    RequestItems=request_items, ReturnConsumedCapacity='TOTAL'), len(request_items[self.table.name]))
+                request_items = response.get('UnprocessedItems')
+
+    def scan(self):
+        """
+        Read every item in the table using a parallel segmented scan
+        :return: <list> The items
+        """
+        items = []
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            for segment in executor.map(self.scan_segment, range(self.segments)):
+                items += segment
+        return items
+
+    def versions(self):
+        """
+        Read the key and version of every header and log entry from the versions index. Without the index every
+        item is scanned, and a projection does not lower what a scan costs, so this reads the whole table
+        :return: <list> (key, version) of each item
+        """
+        index_name = VERSIONS_INDEX if self.indexed else None
+        items = []
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            for segment in executor.map(lambda s: self.scan_segment(s, ['index', 'version'], index_name),
+                                        range(self.segments)):
+                items += [(item['index'], item['version']) for item in segment]
+        return items
+
+    def create_versions_index(self):
+        """
+        Add the versions index to a table written before it existed. The headers and log entries already stored
+        are listed first, along with the first chunk of each block that has no header, so that versions() still
+        finds blocks written before headers existed. Items written from now on are listed as they are written
+        """
+        keys = [item['index'] for s in range(self.segments) for item in self.scan_segment(s, ['index'])]
+        headers = set(key for key in keys if key.endswith("_header"))
+        for key in keys:
+            if listed(key) or (key.endswith(")_0") and key[:-1] + "header" not in headers):
+                try:
+                    self.capacity.call("write", lambda: self.table.update_item(
+                        Key={'index': key}, UpdateExpression="SET #l = :l", ConditionExpression=Attr('index').exists(),
+                        ExpressionAttributeNames={'#l': LISTED}, ExpressionAttributeValues={':l': key},
+                        ReturnConsumedCapacity='TOTAL'))
+                except self.dynamodb_client.exceptions.ConditionalCheckFailedException:
+                    # Deleted since the scan, eg. a compacted log entry
+                    pass
+
+        index = {
+            'IndexName': VERSIONS_INDEX,
+            'KeySchema': [{'AttributeName': LISTED, 'KeyType': 'HASH'}],
+            'Projection': {'ProjectionType': 'INCLUDE', 'NonKeyAttributes': ['version']},
+        }
+        throughput = self.table.provisioned_throughput or {}
+        if throughput.get('ReadCapacityUnits'):
+            index['ProvisionedThroughput'] = {'ReadCapacityUnits': throughput['ReadCapacityUnits'],
+                                              'WriteCapacityUnits': throughput['WriteCapacityUnits']}
+        self.table.update(AttributeDefinitions=[{'AttributeName': LISTED, 'AttributeType': 'S'}],
+                          GlobalSecondaryIndexUpdates=[{'Create': index}])
+
+    def scan_segment(self, segment, attributes=None, index_name=None):
+        """
+        Read every item in one segment of the table
+        :param segment: <int> The segment to scan
+        :param attributes: <list> Only read these attributes of each item, all of them if None
+        :param index_name: <str> The index to scan instead of the table, None to scan the table
+        :return: <list> The items in the segment
+        """
+        scan_kwargs = {
+            'Segment': segment,
+            'TotalSegments': self.segments,
+            'ReturnConsumedCapacity': 'TOTAL',
+        }
+        if index_name is not None:
+            scan_kwargs['IndexName'] = index_name
+        if attributes is not None:
+            scan_kwargs['ProjectionExpression'] = ", ".join("#a" + str(n) for n in range(len(attributes)))
+            scan_kwargs['ExpressionAttributeNames'] = {"#a" + str(n): a for n, a in enumerate(attributes)}
+        items = []
+        done = False
+        while not done:
+            response = self.capacity.call("read", lambda: self.table.scan(**scan_kwargs))
+            items += [self.from_dynamodb(item) for item in response['Items']]
+            start_key = response.get('LastEvaluatedKey', None)
+            if start_key:
+                scan_kwargs['ExclusiveStartKey'] = start_key
+            done = start_key is None
+        return items
+
+    def stats(self):
+        return self.capacity.stats()
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path):
+        """
+        Keep the grid in a local SQLite database
+        :param path: <str> Path to the database file (or ":memory:")
+        """
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS grid "
+                                "(key TEXT PRIMARY KEY, version INTEGER NOT NULL, block BLOB)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute("SELECT key, version, block FROM grid WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {"index": row[0], "version": row[1], "block": row[2]}
+
+    def put(self, item, previous_version=None):
+        with self.lock:
+            if previous_version is None:
+                cursor = self.connection.execute("INSERT OR REPLACE INTO grid (key, version, block) VALUES (?, ?, ?)",
+                                                 (item["index"], int(item["version"]), item["block"]))
+            else:
+                cursor = self.connection.execute(
+                    "INSERT INTO grid (key, version, block) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET version = excluded.version, block = excluded.block "
+                    "WHERE grid.version = ?",
+                    (item["index"], int(item["version"]), item["block"], int(previous_version)))
+        return cursor.rowcount == 1
+
+    def insert(self, item):
+        with self.lock:
+            cursor = self.connection.execute("INSERT OR IGNORE INTO grid (key, version, block) VALUES (?, ?, ?)",
+                                             (item["index"], int(item["version"]), item["block"]))
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM grid WHERE key = ?", (key,))
+
+    def write_many(self, items, condition=None):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if condition is not None:
+                    row = self.connection.execute("SELECT version FROM grid WHERE key = ?",
+                                                  (condition[0],)).fetchone()
+                    if row is not None and row[0] != int(condition[1]):
+                        self.connection.execute("ROLLBACK")
+                        return False
+                self.connection.executemany("INSERT OR REPLACE INTO grid (key, version, block) VALUES (?, ?, ?)",
+                                            [(item["index"], int(item["version"]), item["block"]) for item in items])
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+        return True
+
+    def delete_many(self, keys):
+        with self.lock:
+            self.connection.executemany("DELETE FROM grid WHERE key = ?", [(key,) for key in keys])
+
+    def scan(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT key, version, block FROM grid").fetchall()
+        return [{"index": row[0], "version": row[1], "block": row[2]} for row in rows]
+
+    def versions(self):
+        with self.lock:
+            return self.connection.execute("SELECT key, version FROM grid").fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
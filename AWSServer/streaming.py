@@ -0,0 +1,64 @@
+from flask import jsonify, stream_with_context
+
+from block import plain
+
+# Rendered JSON is sent in pieces of about this many characters
+CHUNK_CHARS = 65536
+
+
+def grid_json(app, response, grid_key):
+    """
+    Render response the way jsonify does, encoding the grid held in response[grid_key] one block at a time. The
+    grid's index keys are written as "i:j:k"
+    :param app: <Flask> The app whose JSON settings are used
+    :param response: <dict> The response
+    :param grid_key: <str> The key of the grid in the response
+    :return: <generator> The pieces of the JSON document
+    """
+    sort_keys = app.config["JSON_SORT_KEYS"]
+    encode = app.json_encoder(separators=(",", ":"), sort_keys=sort_keys,
+                              ensure_ascii=app.config["JSON_AS_ASCII"]).encode
+
+    def pieces():
+        yield "{"
+        for n, key in enumerate(sorted(response) if sort_keys else list(response)):
+            yield ("," if n else "") + encode(key) + ":"
+            if key != grid_key:
+                yield encode(response[key])
+                continue
+
+            grid = response[key]
+            names = {":".join(map(str, idx)): idx for idx in list(grid)}
+            yield "{"
+            for m, name in enumerate(sorted(names) if sort_keys else list(names)):
+                yield ("," if m else "") + encode(name) + ":" + encode(plain(grid[names[name]]))
+            yield "}"
+        yield "}\n"
+
+    buffer = []
+    size = 0
+    for piece in pieces():
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHUNK_CHARS:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    yield "".join(buffer)
+
+
+def stream_grid(app, response, grid_key):
+    """
+    A response streaming the same JSON jsonify would send, without rendering the whole grid in memory first
+    :param app: <Flask> The app
+    :param response: <dict> The response
+    :param grid_key: <str> The key of the grid in the response
+    :return: <Response>
+    """
+    # Pretty printed output is only used for debugging, it is rendered in one go
+    if app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug:
+        grid = {":".join(map(str, k)): plain(v) for k, v in response[grid_key].items()}
+        return jsonify(dict(response, **{grid_key: grid}))
+
+    return app.response_class(stream_with_context(grid_json(app, response, grid_key)),
+                              mimetype=app.config["JSONIFY_MIMETYPE"])
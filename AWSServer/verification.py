@@ -0,0 +1,184 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+from Crypto.PublicKey import RSA
+
+from sign import verify
+
+# Forking the threaded server would copy locks its other threads hold, eg. keys_lock, into the workers, where
+# nothing ever releases them. Workers are started from a clean process instead
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Set in each worker process, tells it to stop verifying
+stop_event = None
+
+# The parsed keys of the owners seen most recently by this process, at most KEY_CACHE_SIZE of them
+KEY_CACHE_SIZE = 1024
+keys = OrderedDict()
+keys_lock = threading.Lock()
+
+
+def init_worker(event):
+    global stop_event
+    stop_event = event
+
+
+def load_key(owner):
+    """
+    Parse the public key of an owner, keeping the most recently used keys parsed
+    :param owner: <str|bytes|RsaKey> The owner of a block
+    :return: <RsaKey> The key, or owner itself if it cannot be parsed (its signatures then fail to verify)
+    """
+    if not isinstance(owner, (str, bytes)):
+        return owner
+    with keys_lock:
+        if owner in keys:
+            keys.move_to_end(owner)
+            return keys[owner]
+    try:
+        key = RSA.importKey(owner)
+    except (ValueError, IndexError, TypeError):
+        key = owner
+    with keys_lock:
+        keys[owner] = key
+        while len(keys) > KEY_CACHE_SIZE:
+            keys.popitem(last=False)
+    return key
+
+
+def transportable(owner):
+    """
+    Keys cannot be pickled, so they are sent to the worker processes as PEM
+    """
+    return owner.exportKey() if isinstance(owner, RSA.RsaKey) else owner
+
+
+def signature_digest(owner, data, signature):
+    """
+    :param owner: <str|bytes|RsaKey> The key the signature is checked with
+    :param data: <bytes> The data that was signed
+    :param signature: <bytes> The signature
+    :return: <bytes> A SHA-256 digest identifying the signature. Types are part of it, since str data never verifies
+    """
+    h = hashlib.sha256()
+    for part in (transportable(owner), data, signature):
+        raw = part if isinstance(part, bytes) else str(part).encode()
+        h.update(f"{type(part).__name__}:{len(raw)}:".encode())
+        h.update(raw)
+    return h.digest()
+
+
+def verify_all(signatures, should_stop=None):
+    """
+    Verify signatures in order, stopping at the first one that fails
+    :param signatures: <list> (owner, data, signature) of each signature
+    :param should_stop: <function> Stops verifying when it returns True, defaults to checking the event the
+                        worker process was started with
+    :return: <bool> True if every signature was verified, False if one failed, None if it was stopped
+    """
+    should_stop = should_stop if should_stop is not None else stop_event.is_set
+    for n, (owner, data, signature) in enumerate(signatures):
+        if n % 64 == 0 and should_stop():
+            return None
+        try:
+            if not verify(load_key(owner), data, signature):
+                return False
+        except AttributeError:
+            # Not a key we can verify with
+            return False
+    return True
+
+
+class Verifier(object):
+    def __init__(self, workers=None, chunk=500, parallel_signatures=2000, cache=None, timeout=60.0):
+        """
+        Verifies batches of signatures on several processes
+        :param workers: <int> Number of processes to verify with, defaults to the number of CPUs
+        :param chunk: <int> How many signatures are sent to a worker at a time
+        :param parallel_signatures: <int> Smaller batches are verified in the calling process
+        :param cache: <SignatureCache> Signatures that have already been verified, they are not verified again
+        :param timeout: <float> How many seconds the workers may go without finishing a chunk before the chunks
+                        they have not finished are verified in the calling process
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk = chunk
+        self.parallel_signatures = parallel_signatures
+        self.cache = cache
+        self.timeout = timeout
+
+    def verify(self, signatures):
+        """
+        :param signatures: <list> (owner, data, signature) of each signature
+        :return: <bool> True if every signature is valid, False as soon as one is found that is not
+        """
+        if self.cache is None:
+            return self.verify_uncached(signatures)
+
+        unverified = [(s, digest) for s, digest in ((s, signature_digest(*s)) for s in signatures)
+                      if digest not in self.cache]
+        # Only a batch that passed as a whole is known to be valid, nothing is remembered from a failed one
+        if not self.verify_uncached([s for s, _ in unverified]):
+            return False
+        for _, digest in unverified:
+            self.cache.add(digest)
+        return True
+
+    def verify_uncached(self, signatures):
+        if len(signatures) < self.parallel_signatures or self.workers == 1:
+            return verify_all(signatures, lambda: False)
+
+        chunks = [[(transportable(owner), data, signature) for owner, data, signature in signatures[i:i + self.chunk]]
+                  for i in range(0, len(signatures), self.chunk)]
+        ctx = multiprocessing.get_context(START_METHOD)
+        stop = ctx.Event()
+        pool = ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=init_worker, initargs=(stop,))
+        pending = {pool.submit(verify_all, chunk): chunk for chunk in chunks}
+        stalled = False
+        try:
+            while pending:
+                done, _ = wait(pending, timeout=self.timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    stalled = True
+                    break
+                if any(future.result() is False for future in done):
+                    return False
+                for future in done:
+                    del pending[future]
+        finally:
+            # Chunks that have not started are dropped and running ones stop early
+            stop.set()
+            for future in pending:
+                future.cancel()
+            # Workers that stopped responding are not waited for
+            pool.shutdown(wait=not stalled)
+        return all(verify_all(chunk, lambda: False) for chunk in pending.values())
+
+
+if __name__ == "__main__":
+    # Compare verifying one signature at a time, as valid_gird used to, with the Verifier, in signatures per second
+    from sign import rsakeys, sign
+
+    private_key, public_key = rsakeys()
+    owner = public_key.exportKey()
+    messages = [str(n).encode() for n in range(100)]
+    signed = [(owner, m, sign(private_key, m)) for m in messages]
+
+    for n in (1000, 10000, 100000):
+        signatures = [signed[i % len(signed)] for i in range(n)]
+
+        start = time()
+        for o, data, signature in signatures:
+            verify(RSA.importKey(o), data, signature)
+        sequential = time() - start
+
+        start = time()
+        assert Verifier().verify(signatures)
+        parallel = time() - start
+        print(f"{n} signatures: {n / sequential:,.0f}/s one at a time, {n / parallel:,.0f}/s with the Verifier "
+              f"({os.cpu_count()} CPUs)")
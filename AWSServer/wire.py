@@ -0,0 +1,294 @@
+import gzip
+import json
+import zlib
+
+import urllib3
+
+from decimal import Decimal
+
+from flask import jsonify, stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from block import Record
+from streaming import grid_json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+
+# The most bytes a request body may decompress to, a few KB of gzip or zstd can otherwise expand to gigabytes
+MAX_REQUEST_BYTES = 256 * 2 ** 20
+
+
+def media_types():
+    """
+    :return: <list> The formats grids can be sent in, in order of preference
+    """
+    return [MSGPACK, JSON] if msgpack is not None else [JSON]
+
+
+def content_encodings():
+    """
+    :return: <list> The compressions that can be used on the wire, in order of preference
+    """
+    return ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+
+
+def decodable_encodings():
+    """
+    :return: <list> The compressions requests undoes for us in peer responses, in order of preference. It only
+             decodes zstd with urllib3's own zstd support, whether or not zstandard can be imported here
+    """
+    return ["zstd", "gzip"] if getattr(urllib3.response, "HAS_ZSTD", False) else ["gzip"]
+
+
+def accept_headers():
+    """
+    :return: <dict> The headers a node sends to ask a peer for its preferred format and compression
+    """
+    return {
+        "Accept": ", ".join(f"{t};q={1 - n / 10:.1f}" for n, t in enumerate(media_types())),
+        "Accept-Encoding": ", ".join(decodable_encodings()),
+    }
+
+
+def plain(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Cannot pack {type(obj)}")
+
+
+def pack(response, grid_key=None):
+    """
+    Encode a response as MessagePack. The grid in response[grid_key] is sent as a list of blocks, each block
+    already holds its index
+    :param response: <dict> The response
+    :param grid_key: <str> The key of the grid in the response, if it has one
+    :return: <bytes>
+    """
+    if grid_key is not None:
+        response = dict(response, **{grid_key: [response[grid_key][idx] for idx in list(response[grid_key])]})
+    return msgpack.packb(response, default=plain)
+
+
+def unpack(body, grid_keys=()):
+    """
+    Decode a MessagePack request or response
+    :param body: <bytes> The encoded body
+    :param grid_keys: <iterable> The keys of the grids in the body
+    :return: <dict> The body, with each grid keyed by index
+    """
+    values = msgpack.unpackb(body)
+    for key in grid_keys:
+        if key in values:
+            values[key] = {tuple(block["index"]): block for block in values[key]}
+    return values
+
+
+def parse_json(body, grid_keys=()):
+    """
+    Decode a JSON request or response
+    :param body: <bytes|dict> The encoded or already decoded body
+    :param grid_keys: <iterable> The keys of the grids in the body, whose keys are "i:j:k"
+    :return: <dict> The body, with each grid keyed by index
+    """
+    values = json.loads(body) if isinstance(body, (str, bytes)) else body
+    for key in grid_keys:
+        if key in values:
+            values[key] = {tuple(map(int, k.split(":"))): v for k, v in values[key].items()}
+    return values
+
+
+def compress(data, encoding):
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def decompress(data, encoding, limit=None):
+    """
+    :param data: <bytes> A compressed body
+    :param encoding: <str> "zstd", "gzip" or None if it is not compressed
+    :param limit: <int> The most bytes the body may decompress to, None for no limit
+    :return: <bytes> The body
+    :raises ValueError: If it decompresses to more than limit bytes
+    """
+    if limit is None:
+        if encoding == "zstd":
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        if encoding == "gzip":
+            return gzip.decompress(data)
+        return data
+
+    # Output is produced a piece at a time, so decompression stops as soon as it passes the limit
+    if encoding == "zstd":
+        pieces = zstandard.ZstdDecompressor().read_to_iter(data)
+    elif encoding == "gzip":
+        pieces = gunzip(data, limit + 1)
+    else:
+        pieces = [data]
+    body = bytearray()
+    for piece in pieces:
+        body += piece
+        if len(body) > limit:
+            raise ValueError(f"The body is larger than {limit} bytes")
+    return bytes(body)
+
+
+def gunzip(data, size):
+    """
+    :param data: <bytes> One or more gzip members
+    :param size: <int> The most bytes to decompress at a time
+    :return: <generator> The decompressed pieces
+    """
+    while data:
+        # wbits 31 reads a gzip header and trailer
+        decompressor = zlib.decompressobj(wbits=31)
+        while data:
+            yield decompressor.decompress(data, size)
+            data = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise zlib.error("The gzip stream is truncated")
+        data = decompressor.unused_data
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compress a streamed body as it is sent
+    :param chunks: <iterable> The pieces of the body, str or bytes
+    :param encoding: <str> "zstd" or "gzip"
+    :return: <generator> The compressed pieces
+    """
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        # wbits 31 writes a gzip header and trailer
+        compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        out = compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def read_request(request, grid_keys=()):
+    """
+    Decode the body of a request in whichever format and compression it was sent in
+    :param request: <Request> The request
+    :param grid_keys: <iterable> The keys of the grids in the body
+    :return: <dict> The body, with each grid keyed by index
+    :raises RequestEntityTooLarge: If the body decompresses to more than MAX_REQUEST_BYTES
+    """
+    try:
+        body = decompress(request.get_data(), request.headers.get("Content-Encoding"), MAX_REQUEST_BYTES)
+    except ValueError as e:
+        raise RequestEntityTooLarge(str(e))
+    if len(body) == 0:
+        return {}
+    if request.mimetype == MSGPACK and msgpack is not None:
+        return unpack(body, grid_keys)
+    return parse_json(body, grid_keys)
+
+
+def read_response(response, grid_keys=()):
+    """
+    Decode a peer's response, which requests has already decompressed
+    :param response: <Response> The requests response
+    :param grid_keys: <iterable> The keys of the grids in the body
+    :return: <dict> The body, with each grid keyed by index
+    """
+    if response.headers.get("Content-Type", "").startswith(MSGPACK) and msgpack is not None:
+        return unpack(response.content, grid_keys)
+    return parse_json(response.content, grid_keys)
+
+
+def respond(app, request, response, grid_key=None):
+    """
+    Send a response in the format and compression the client prefers. JSON is the same as jsonify would send,
+    with the grid keyed by "i:j:k" and streamed one block at a time
+    :param app: <Flask> The app
+    :param request: <Request> The request being answered
+    :param response: <dict> The response
+    :param grid_key: <str> The key of the grid in the response, if it has one
+    :return: <Response>
+    """
+    # JSON comes first so clients accepting anything, eg. with */*, keep getting it
+    media_type = request.accept_mimetypes.best_match(media_types()[::-1], default=JSON)
+    encoding = request.accept_encodings.best_match(content_encodings())
+
+    if media_type == MSGPACK:
+        chunks = [pack(response, grid_key)]
+    elif app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug:
+        if grid_key is not None:
+            response = dict(response, **{grid_key: {":".join(map(str, k)): plain(v) if isinstance(v, Record) else v
+                                                    for k, v in response[grid_key].items()}})
+        chunks = [jsonify(response).get_data()]
+    else:
+        chunks = grid_json(app, response, grid_key)
+
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding is not None:
+        chunks = compress_chunks(chunks, encoding)
+        headers["Content-Encoding"] = encoding
+    return app.response_class(stream_with_context(chunks), mimetype=media_type, headers=headers)
+
+
+if __name__ == "__main__":
+    # Compare the size and encode/decode time of a grid sent as JSON, the way it always was, and as MessagePack
+    import random
+    from time import time
+
+    from blockgrid import DecimalEncoder
+
+    n = 20000
+    grid = {}
+    for b in range(n):
+        idx = (b % 40 - 20, b // 40 % 40 - 20, b // 1600)
+        grid[idx] = {
+            'index': idx,
+            'timestamp': Decimal(1600000000 + b),
+            'updated': Decimal(1600000000000 + b),
+            'data': [{'data': json.dumps({f"object{o}": {"filepath": f"bundle{random.randrange(1000)}",
+                                                          "position": [random.uniform(0, 500) for _ in range(3)]}
+                                          for o in range(3)}),
+                      'signature': bytes(random.randrange(256) for _ in range(256)).decode('latin-1'),
+                      'updated': Decimal(1600000000000 + b), 'approved': True} for _ in range(b % 3)],
+            'proof': random.randrange(10 ** 6),
+            'owner': "-----BEGIN PUBLIC KEY-----" + "A" * 392 + "-----END PUBLIC KEY-----",
+            'previous_hash': "%064x" % random.getrandbits(256),
+            'previous_index': idx,
+            'version': Decimal(b % 7),
+        }
+
+    def best(run):
+        times = []
+        for _ in range(3):
+            start = time()
+            out = run()
+            times.append(time() - start)
+        return min(times), out
+
+    formats = {
+        "json": (lambda: json.dumps({'grid': {":".join(map(str, k)): v for k, v in grid.items()}, 'length': n},
+                                    cls=DecimalEncoder).encode(),
+                 lambda body: parse_json(body, ['grid'])),
+        "msgpack": (lambda: pack({'grid': grid, 'length': n}, 'grid'), lambda body: unpack(body, ['grid'])),
+    }
+    for name, (encode, decode) in formats.items():
+        encode_time, body = best(encode)
+        decode_time, _ = best(lambda: decode(body))
+        sizes = ", ".join(f"{encoding} {len(compress(body, encoding)) / 2 ** 20:.1f}MB"
+                          for encoding in content_encodings())
+        print(f"{name}: {len(body) / 2 ** 20:.1f}MB ({sizes}), encode {encode_time * 1000:.0f}ms, "
+              f"decode {decode_time * 1000:.0f}ms")
@@ -248,19 +248,22 @@ class Blockgrid(object):
         last_index = tuple(x if i != index_max else x - 1 * math.copysign(1, x) for i, x in enumerate(index))
         return last_index
 
-    def proof_of_work(self, last_proof, index):
+    def proof_of_work(self, last_proof, index, cancel=None):
         """
         Simple Proof of Work Algorithm:
          - Find a number p' such that hash(pp') contains leading 4 zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
         :param last_proof: <int>
         :param index: <int>
-        :return: <int>
+        :param cancel: <Event> Give up when this is set
+        :return: <int> The proof, or None if the search was cancelled
         """
 
         proof = 0
         while self.valid_proof(last_proof, proof, index) is False:
             proof += 1
+            if cancel is not None and proof % 10000 == 0 and cancel.is_set():
+                return None
 
         return proof
 
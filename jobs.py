@@ -0,0 +1,138 @@
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from uuid import uuid4
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Claimed(object):
+    def __init__(self, blockgrid, index, refresh_interval):
+        """
+        Looks like an Event to the miner. It is set once the job is cancelled or the block has been mined by
+        someone else, which is checked against storage every refresh_interval seconds
+        """
+        self.blockgrid = blockgrid
+        self.index = index
+        self.refresh_interval = refresh_interval
+        self.checked = time()
+        self.cancelled = False
+
+    def set(self):
+        self.cancelled = True
+
+    def is_set(self):
+        if self.cancelled:
+            return True
+        if self.refresh_interval is not None and time() - self.checked > self.refresh_interval:
+            self.checked = time()
+            self.blockgrid.refresh_index(self.index)
+        return self.blockgrid.grid[self.index]["owner"] is not None
+
+
+class MiningJobs(object):
+    def __init__(self, blockgrid, workers=1, max_pending=8, max_finished=1000, refresh_interval=10.0):
+        """
+        Runs proofs of work in the background so /mine can return straight away
+        :param blockgrid: <Blockgrid> The grid the mined blocks are signed into
+        :param workers: <int> How many blocks are mined at the same time
+        :param max_pending: <int> How many jobs can be queued or running before new ones are refused
+        :param max_finished: <int> How many finished jobs are remembered for status requests
+        :param refresh_interval: <float> How often a running job checks storage for whether its block was mined
+                                 by another node, None to only check our own grid
+        """
+        self.blockgrid = blockgrid
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        # The unfinished job for each index, so repeated requests for a block share one job
+        self.active = {}
+
+    def submit(self, index, owner):
+        """
+        Queue a job mining the block at index for owner, or return the job already mining it
+        :param index: <tuple> The index of the block
+        :param owner: <str> The public key of the miner
+        :return: <dict> The job
+        """
+        with self.lock:
+            if index in self.active:
+                return self.jobs[self.active[index]]
+            if len(self.active) >= self.max_pending:
+                raise QueueFull()
+
+            job = {
+                'id': str(uuid4()).replace('-', ''),
+                'index': index,
+                'owner': owner,
+                'status': 'queued',
+                'submitted': time(),
+                'result': None,
+                'cancel': Claimed(self.blockgrid, index, self.refresh_interval),
+            }
+            self.jobs[job['id']] = job
+            self.active[index] = job['id']
+            self.executor.submit(self.run, job)
+            return job
+
+    def get(self, job_id):
+        """
+        :param job_id: <str> The id of a job
+        :return: <dict> The job, or None if there is no such job
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    @staticmethod
+    def describe(job):
+        """
+        :return: <dict> The parts of a job that are returned to clients
+        """
+        return {k: v for k, v in job.items() if k != 'cancel'}
+
+    def run(self, job):
+        index = job['index']
+        try:
+            job['status'] = 'running'
+            if self.blockgrid.grid[index]["owner"] is not None:
+                job['status'] = 'cancelled'
+                return
+
+            block = self.blockgrid.grid[index].copy()
+            block["owner"] = job['owner']
+            last_proof = self.blockgrid.hash_without_proof(block)
+            proof = self.blockgrid.proof_of_work(last_proof, index, cancel=job['cancel'])
+
+            # Someone else may have mined the block while we were working on it
+            with self.lock:
+                if proof is None or self.blockgrid.grid[index]["owner"] is not None:
+                    job['status'] = 'cancelled'
+                    return
+                # Forge the new Block by adding it to the chain
+                self.blockgrid.sign_block(index, proof, job['owner'])
+
+            job['result'] = {
+                'message': "New Block Forged",
+                'index': self.blockgrid.grid[index]['index'],
+                'owner': self.blockgrid.grid[index]['owner'],
+                'data': self.blockgrid.grid[index]['data'],
+                'proof': self.blockgrid.grid[index]['proof'],
+                'previous_hash': self.blockgrid.grid[index]['previous_hash'],
+            }
+            job['status'] = 'done'
+        except Exception as e:
+            job['status'] = 'failed'
+            job['result'] = {'message': str(e)}
+        finally:
+            with self.lock:
+                del self.active[index]
+                finished = [job_id for job_id, j in self.jobs.items() if j['status'] not in ('queued', 'running')]
+                for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+                    del self.jobs[job_id]
@@ -1,12 +1,32 @@
 import unittest
 from start import get_app
 import json
+import time
 
 
 class MiningTest(unittest.TestCase):
     def setUp(self):
         pass
 
+    def mine(self, client, index, public_key):
+        """
+        Start mining a block, wait for the mining job to finish and check that the block was mined
+        :return: The response of the last status request, or of /mine if no job was started
+        """
+        response = client.get('/mine', data=json.dumps({"index": index, "signature": public_key}),
+                              content_type='application/json')
+        if response.status_code != 202:
+            return response
+
+        job_id = response.get_json()["id"]
+        while True:
+            response = client.get('/mine/' + job_id)
+            if response.get_json()["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.01)
+        self.assertEqual(response.get_json()["status"], "done", response.get_json().get("result"))
+        return response
+
     def test_different_lengths(self):
         client1 = get_app().test_client()
         client2 = get_app().test_client()
@@ -14,13 +34,11 @@ class MiningTest(unittest.TestCase):
         public_key2 = "key2"
 
         for block in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (2, 0, 0)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key1}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key1)
             self.assertEqual(response.status_code, 200)
 
         for block in [(0, 0, 0), (0, 0, 1), (1, 0, 0), (2, 0, 0)]:
-            response = client2.get('/mine', data=json.dumps({"index": block, "signature": public_key2}),
-                                   content_type='application/json')
+            response = self.mine(client2, block, public_key2)
             self.assertEqual(response.status_code, 200)
 
         grid1 = dict(client1.get('/grid').get_json().get('grid'))
@@ -40,8 +58,7 @@ class MiningTest(unittest.TestCase):
         public_key = "key"
 
         for block in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (2, 0, 0)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key)
             self.assertEqual(response.status_code, 200)
 
         client2.put('/grid/replace', data=json.dumps({"grid": dict(client1.get('/grid').get_json().get('grid'))}),
@@ -65,16 +82,14 @@ class MiningTest(unittest.TestCase):
         public_key = "key"
 
         for block in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (2, 0, 0)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key)
             self.assertEqual(response.status_code, 200)
 
         client2.put('/grid/replace', data=json.dumps({"grid": dict(client1.get('/grid').get_json().get('grid'))}),
                     content_type='application/json')
 
         for block in [(0, 0, 2), (0, 2, 0)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key)
             client1.post('/transactions/new', data=json.dumps({'index': block, 'data': "test", 'signature': public_key})
                          , content_type='application/json')
             self.assertEqual(response.status_code, 200)
@@ -92,23 +107,20 @@ class MiningTest(unittest.TestCase):
         public_key = "key"
 
         for block in [(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (2, 0, 0)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key)
             self.assertEqual(response.status_code, 200)
 
         client2.put('/grid/replace', data=json.dumps({"grid": dict(client1.get('/grid').get_json().get('grid'))}),
                     content_type='application/json')
 
         for block in [(0, 0, 2), (0, 2, 0), (0, 0, 3)]:
-            response = client1.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client1, block, public_key)
             client1.post('/transactions/new', data=json.dumps({'index': block, 'data': "test", 'signature': public_key})
                          , content_type='application/json')
             self.assertEqual(response.status_code, 200)
 
         for block in [(3, 0, 0), (0, 2, 0)]:
-            response = client2.get('/mine', data=json.dumps({"index": block, "signature": public_key}),
-                                   content_type='application/json')
+            response = self.mine(client2, block, public_key)
             client1.post('/transactions/new', data=json.dumps({'index': block, 'data': "test", 'signature': public_key})
                          , content_type='application/json')
             self.assertEqual(response.status_code, 200)
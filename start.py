@@ -8,6 +8,7 @@ from flask_limiter.util import get_remote_address
 from sign import load_saved_keys, sign
 
 from blockgrid import Blockgrid
+from jobs import MiningJobs, QueueFull
 
 
 def get_app():
@@ -21,6 +22,7 @@ def get_app():
 
     node_identifier = str(uuid4()).replace('-', '')
     blockgrid = Blockgrid()
+    mining_jobs = MiningJobs(blockgrid, refresh_interval=None)
 
     # if os.path.isfile("./blockgrid.pkl"):
     #    blockgrid.load("blockgrid.pkl")
@@ -28,7 +30,6 @@ def get_app():
     @app.route('/mine', methods=['GET'])
     @limiter.limit("20 per hour")
     def mine():
-        # We run the proof of work algorithm to get the next proof...
         values = request.get_json()
 
         index = tuple(values["index"])
@@ -39,24 +40,22 @@ def get_app():
         if blockgrid.grid[index]["owner"] is not None:
             return 'Block has already been mined', 400
 
-        block = blockgrid.grid[index].copy()
-        block["owner"] = values["signature"]
-        last_proof = blockgrid.hash_without_proof(block)
-        proof = blockgrid.proof_of_work(last_proof, index)
+        # The proof of work is run in the background, the result is fetched from /mine/<job_id>
+        try:
+            job = mining_jobs.submit(index, values["signature"])
+        except QueueFull:
+            return 'Too many blocks are being mined, try again later', 503
 
-        # Forge the new Block by adding it to the chain
-        blockgrid.sign_block(index, proof, values["signature"])
+        return jsonify(mining_jobs.describe(job)), 202
 
-        response = {
-            'message': "New Block Forged",
-            'index': blockgrid.grid[index]['index'],
-            'owner': blockgrid.grid[index]['owner'],
-            'data': blockgrid.grid[index]['data'],
-            'proof': blockgrid.grid[index]['proof'],
-            'previous_hash': blockgrid.grid[index]['previous_hash'],
-        }
+    @app.route('/mine/<job_id>', methods=['GET'])
+    @limiter.limit("600 per hour")
+    def mining_status(job_id):
+        job = mining_jobs.get(job_id)
+        if job is None:
+            return 'Unknown mining job', 404
 
-        return jsonify(response), 200
+        return jsonify(mining_jobs.describe(job)), 200
 
     @app.route('/transactions/new', methods=['POST'])
     def new_transaction():